@@ -1,25 +1,38 @@
 #! /usr/bin/python3
 
 import argparse
-from typing import TypedDict
+import atexit
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager, suppress
+from functools import cache, partial
+from itertools import islice
+import fcntl
+import glob
+import hashlib
+import threading
+from typing import Callable, Iterator, TypedDict
 import os
 import re
+import shlex
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import socket
+import statistics
+import subprocess
 import json
 import sys
+import tempfile
 from langcodes import tag_is_valid
 
-mw_versions = os.popen('/usr/local/bin/getMWVersions').read().strip()
-versions = {'version': 'version'}
-if mw_versions:
-    versions = json.loads(mw_versions)
-repos = {**versions, 'config': 'config', 'errorpages': 'ErrorPages', 'landing': 'landing'}
-
-del mw_versions
+# filled on first use by get_versions()
+versions: dict[str, str] = {}
 
 DEPLOYUSER = 'www-data'
+CANARY_TIMEOUT = (5, 30)  # connect, read
+CANARY_RETRIES = 3
+CACHE_DIR = os.path.expanduser('~/.cache/mwdeploy')
 
 
 class Environment(TypedDict):
@@ -33,6 +46,101 @@ class EnvironmentList(TypedDict):
     prod: Environment
 
 
+class SyncResult(TypedDict):
+    server: str
+    path: str
+    ec: int
+    duration: float
+
+
+class RepoIndexEntry(TypedDict):
+    mtime: float
+    repos: list[str]
+
+
+class ManifestEntry(TypedDict):
+    size: int
+    mtime: float
+    sha1: str
+
+
+class ProbeResult(TypedDict):
+    server: str
+    up: bool
+    status: int | None
+    latency: float
+
+
+class DeployStep(TypedDict):
+    phase: str
+    description: str
+    action: Callable[[], list[int]]
+    deps: list[str]
+
+
+class StepInputs(TypedDict):
+    inputs: list[str]
+    repos: list[str]
+    trees: list[str]
+    outputs: list[str]
+
+
+class DeployJournal(TypedDict):
+    heads: dict[str, str]
+    upgraded: list[str]
+    completed: dict[str, str]
+
+
+class ReleaseConfig(TypedDict):
+    release: str
+    keep: int
+    paths: list[str]
+    files_from: dict[str, str]
+
+
+class RolloutConfig(TypedDict):
+    wave_size: int
+    canaries: int
+    max_error_rate: float
+    max_latency: float
+
+
+class ProgressConfig(TypedDict):
+    straggler_ratio: float
+    defer: bool
+
+
+class RsyncProgress(TypedDict):
+    transferred: int
+    percent: int
+    rate: float
+    eta: str
+    files: int
+
+
+class TransferProgress(RsyncProgress):
+    server: str
+    started: float
+    done: bool
+    deferred: bool
+
+
+class SyncController(TypedDict):
+    workers: int
+    max_workers: int
+    bwlimit: int  # KiB/s per transfer, 0 for no limit
+    min_bwlimit: int
+    max_bwlimit: int
+    latency_target: float
+    throughput: float  # bytes/s of the last batch
+
+
+class PullResult(TypedDict):
+    repo: str
+    ec: int
+    output: str
+
+
 beta: Environment = {
     'wikidbname': 'metawikibeta',
     'wikiurl': 'meta.mirabeta.org',
@@ -62,6 +170,109 @@ del beta
 del prod
 HOSTNAME = socket.gethostname().split('.')[0]
 
+# output prefix of the version pipeline running in this thread, see run_versions()
+_output = threading.local()
+# one version at a time pushes to the servers when pipelines run concurrently
+_remote_sync_lock = threading.Lock()
+
+# ssh ControlPath of the multiplexed connections, see start_ssh_multiplexing()
+_ssh_control_path: str | None = None
+# socket of the agent holding the relay key, see start_relay_agent()
+_relay_agent_socket: str | None = None
+# the servers authorise this key only for deploy user rsyncs between each other, never the deploy key
+RELAY_KEY = '/srv/mediawiki-staging/relaykey'
+RELAY_AGENT_LIFETIME = 3600
+
+# (server, path) -> live rsync progress for --progress, see run_transfer()
+_transfers: dict[tuple[str, str], TransferProgress] = {}
+_transfers_lock = threading.Lock()
+_transfers_shown = 0.0
+PROGRESS_INTERVAL = 2
+# seconds a transfer runs before its rate counts towards straggler detection
+STRAGGLER_GRACE = 10
+# seconds between canary probes of the servers an adaptive batch syncs to
+CONTROLLER_PROBE_INTERVAL = 2
+RSYNC_PROGRESS_REGEX = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?)B/s\s+(\d+:\d{2}:\d{2})(?:\s+\(xfr#(\d+),)?')
+
+# Chrome trace events for --trace, see trace_span()
+_trace_events: list[dict] = []
+_trace_start: float | None = None
+
+# (path, version) -> change tag -> files, filled from one git diff per repository
+_change_index: dict[tuple[str, str], dict[str, set[str]]] = {}
+_changed_files: dict[tuple[str, str], list[str]] = {}
+# staging directory -> git repositories in it, persisted to REPO_INDEX_FILE
+_repo_index: dict[str, RepoIndexEntry] = {}
+REPO_INDEX_FILE = os.path.join(CACHE_DIR, 'repo-index.json')
+# getMWVersions output, reused until the TTL expires or /srv/mediawiki-staging changes
+VERSIONS_CACHE_FILE = os.path.join(CACHE_DIR, 'versions.json')
+VERSIONS_CACHE_TTL = 3600
+# hash tree of each synced path, and the digest last pushed per server and path
+MANIFEST_DIR = os.path.join(CACHE_DIR, 'manifests')
+# shared by every deployer on this host, what one pushed is what the others skip
+SHARED_STATE_DIR = '/srv/mediawiki-staging/.mwdeploy'
+PUSHED_MANIFEST_FILE = os.path.join(SHARED_STATE_DIR, 'pushed-manifests.json')
+
+# input fingerprint of each step as of its last successful run, the outputs are shared host state too
+FINGERPRINT_FILE = os.path.join(SHARED_STATE_DIR, 'fingerprints.json')
+
+# release directory of every version tree this run deploys, see --releases
+RELEASE_ID = time.strftime('%Y%m%d-%H%M%S')
+
+JOURNAL_DIR = os.path.join(CACHE_DIR, 'journal')
+# options that change how a deploy runs but not what it deploys
+JOURNAL_IGNORED_ARGS = ('resume', 'dry_run', 'trace', 'jobs', 'step_jobs', 'parallel', 'parallel_versions', 'probe', 'reuse_ssh', 'nolog', 'show_tags', 'ignore_fingerprints', 'relay_fanout', 'progress', 'straggler_ratio', 'defer_stragglers', 'adaptive', 'latency_target', 'min_bwlimit', 'max_bwlimit')
+
+
+def inherit_output(function: Callable) -> Callable:
+    # worker threads keep printing with the version prefix of the thread that queued them
+    prefix = getattr(_output, 'prefix', '')
+
+    def wrapper(*args, **kwargs):
+        _output.prefix = prefix
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sys.stdout.flush()
+            _output.prefix = ''
+
+    return wrapper
+
+
+def start_trace() -> None:
+    global _trace_start
+    _trace_events.clear()
+    _trace_start = time.perf_counter()
+
+
+@contextmanager
+def trace_span(name: str, category: str = 'deploy', **args: object) -> Iterator[dict]:
+    # records a complete ('X') event, nested spans are shown inside their parent per thread
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        if _trace_start is not None:
+            _trace_events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - _trace_start) * 1000000,
+                'dur': (time.perf_counter() - start) * 1000000,
+                'pid': os.getpid(),
+                'tid': threading.get_native_id(),
+                'args': args,
+            })
+
+
+def write_trace(path: str) -> None:
+    threads = {event['tid'] for event in _trace_events}
+    names = {thread.native_id: thread.name for thread in threading.enumerate()}
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': names.get(tid, f'worker-{tid}')}} for tid in threads]
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': metadata + _trace_events, 'displayTimeUnit': 'ms'}, trace_file)
+    print(f'Trace written to {path}')
+
 
 def get_environment_info() -> Environment:
     if HOSTNAME.startswith('test'):
@@ -69,21 +280,131 @@ def get_environment_info() -> Environment:
     return ENVIRONMENTS['prod']
 
 
+def _load_cache_file(path: str) -> dict:
+    with suppress(OSError, ValueError), open(path) as cache_file:
+        return json.load(cache_file)
+    return {}
+
+
+def _save_cache_file(path: str, data: dict, mode: int | None = None) -> bool:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(data, cache_file)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Unable to save {path}: {e}')
+        return False
+    return True
+
+
+def _get_versions_cache() -> dict:
+    try:
+        listing = sorted(os.listdir('/srv/mediawiki-staging'))
+    except OSError:
+        listing = []
+    cached = _load_cache_file(VERSIONS_CACHE_FILE)
+    if cached.get('listing') == listing and time.time() - cached.get('time', 0) < VERSIONS_CACHE_TTL:
+        return cached
+    return {'listing': listing, 'time': time.time(), 'versions': {}}
+
+
+def get_versions() -> dict[str, str]:
+    if not versions:
+        cache = _get_versions_cache()
+        if not cache['versions']:
+            mw_versions = os.popen('/usr/local/bin/getMWVersions').read().strip()
+            if mw_versions:
+                cache['versions'] = json.loads(mw_versions)
+                _save_cache_file(VERSIONS_CACHE_FILE, cache)
+        versions.update(cache['versions'] or {'version': 'version'})
+    return versions
+
+
+def get_repos() -> dict[str, str]:
+    return {**get_versions(), 'config': 'config', 'errorpages': 'ErrorPages', 'landing': 'landing'}
+
+
+def get_default_version() -> str:
+    # never cached, moving the wiki to another version only changes config. it runs once, without --versions
+    return os.popen(f'/usr/local/bin/getMWVersion {get_environment_info()["wikidbname"]}').read().strip()
+
+
+def _get_namespace_versions(namespace: argparse.Namespace) -> list[str]:
+    if getattr(namespace, 'versions', None) is None:
+        namespace.versions = [get_default_version()]
+    return namespace.versions
+
+
+def get_l10n_languages(version: str) -> list[str]:
+    # languages with a core MessagesXx.php or i18n/xx.json file, as rebuildLocalisationCache.php uses by default
+    languages_path = f'/srv/mediawiki/{version}/languages'
+    languages = set()
+    with suppress(OSError):
+        for file in os.listdir(f'{languages_path}/messages'):
+            if file.startswith('Messages') and file.endswith('.php'):
+                languages.add(file[len('Messages'):-len('.php')].lower().replace('_', '-'))
+    with suppress(OSError):
+        for file in os.listdir(f'{languages_path}/i18n'):
+            if file.endswith('.json'):
+                languages.add(file[:-len('.json')])
+    languages.discard('qqq')
+    return sorted(languages)
+
+
+def shard_languages(languages: list[str], shards: int) -> list[list[str]]:
+    # round robin, so the large languages at the start of the alphabet don't share a shard
+    return [group for group in (languages[shard::shards] for shard in range(shards)) if group]
+
+
+def get_l10n_rebuild_commands(version: str, shards: int, lang: str | None, runner: str, wiki: str) -> list[str]:
+    # listed when the step runs, the world rsync before it may add or remove languages
+    rebuild = f'sudo -u {DEPLOYUSER} php {runner}/srv/mediawiki/{version}/maintenance/rebuildLocalisationCache.php'
+    languages = lang.split(',') if lang else get_l10n_languages(version)
+    if not languages:
+        print(f'No languages found in /srv/mediawiki/{version}/languages, rebuilding l10n unsharded.')
+        return [f'{rebuild}  --quiet --wiki={wiki}']
+    return [f'{rebuild} --lang={",".join(group)} --quiet --wiki={wiki}' for group in shard_languages(languages, shards)]
+
+
+def rebuild_l10n_sharded(version: str, shards: int, lang: str | None, runner: str, wiki: str) -> list[int]:
+    return run_commands_parallel(get_l10n_rebuild_commands(version, shards, lang, runner, wiki))
+
+
+def get_staging_repos(path: str) -> list[str]:
+    # adding or removing a repository changes the mtime of its parent directory
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+    if mtime is not None:
+        if not _repo_index:
+            _repo_index.update(_load_cache_file(REPO_INDEX_FILE))
+        entry = _repo_index.get(path)
+        if entry and entry['mtime'] == mtime:
+            return list(entry['repos'])
+    with os.scandir(path) as entries:
+        repos = [entry.name for entry in entries if os.path.isdir(os.path.join(entry.path, '.git'))]
+    if mtime is not None:
+        _repo_index[path] = {'mtime': mtime, 'repos': repos}
+        _save_cache_file(REPO_INDEX_FILE, _repo_index)
+    return list(repos)
+
+
 def get_valid_extensions(versions: list[str]) -> list[str]:
     valid_extensions = []
     for version in versions:
-        extensions_path = f'/srv/mediawiki-staging/{version}/extensions/'
-        with os.scandir(extensions_path) as extensions:
-            valid_extensions += [extension.name for extension in extensions if os.path.isdir(os.path.join(extension.path, '.git'))]
+        valid_extensions += get_staging_repos(f'/srv/mediawiki-staging/{version}/extensions/')
     return sorted(valid_extensions)
 
 
 def get_valid_skins(versions: list[str]) -> list[str]:
     valid_skins = []
     for version in versions:
-        skins_path = f'/srv/mediawiki-staging/{version}/skins/'
-        with os.scandir(skins_path) as skins:
-            valid_skins += [skin.name for skin in skins if os.path.isdir(os.path.join(skin.path, '.git'))]
+        valid_skins += get_staging_repos(f'/srv/mediawiki-staging/{version}/skins/')
     return sorted(valid_skins)
 
 
@@ -106,63 +427,334 @@ def get_skins_in_pack(pack_name: str) -> list[str]:
     return packs.get(pack_name, [])
 
 
-def get_change_tag_map() -> dict[re.Pattern, str]:
-    build_regex = re.compile(r'^.*?(\.github/.*?|\.phan/.*?|tests/.*?|composer(\.json|\.lock)|package(-lock)?\.json|yarn\.lock|(\.phpcs|\.stylelintrc|\.eslintrc|\.prettierrc|\.stylelintignore|\.eslintignore|\.prettierignore|tsconfig)\.json|\.nvmrc|\.svgo\.config\.js|Gruntfile\.js|bundlesize\.config\.json|jsdoc\.json)$')
-    codechange_regex = re.compile(
-        rf'(?!.*{build_regex.pattern})'
-        r'^.*?(\.(php|js|css|less|scss|vue|lua|mustache|d\.ts)|extension(-repo|-client)?\.json|skin\.json)$',
-    )
-    schema_regex = re.compile(
-        rf'(?!.*{build_regex.pattern})'
-        r'^.*?\.sql$',
-    )
-    i18n_regex = re.compile(r'^.*?i18n/.*?\.json$')
-    return {
-        codechange_regex: 'code change',
-        schema_regex: 'schema change',
-        build_regex: 'build',
-        i18n_regex: 'i18n',
-    }
+CHANGE_TAGS = ('code change', 'schema change', 'build', 'i18n')
+BUILD_CHANGE_DIRS = ('.github/', '.phan/', 'tests/')
+BUILD_CHANGE_FILES = (
+    'composer.json',
+    'composer.lock',
+    'package.json',
+    'package-lock.json',
+    'yarn.lock',
+    '.phpcs.json',
+    '.stylelintrc.json',
+    '.eslintrc.json',
+    '.prettierrc.json',
+    '.stylelintignore.json',
+    '.eslintignore.json',
+    '.prettierignore.json',
+    'tsconfig.json',
+    '.nvmrc',
+    '.svgo.config.js',
+    'Gruntfile.js',
+    'bundlesize.config.json',
+    'jsdoc.json',
+)
+CODE_CHANGE_FILES = (
+    '.php',
+    '.js',
+    '.css',
+    '.less',
+    '.scss',
+    '.vue',
+    '.lua',
+    '.mustache',
+    '.d.ts',
+    'extension.json',
+    'extension-repo.json',
+    'extension-client.json',
+    'skin.json',
+)
+
+
+def classify_change(file: str) -> set[str]:
+    # one pass over the suffix and directory tables, see tests/benchmark_change_tags.py for the regexes it replaced
+    tags = set()
+    if file.endswith(BUILD_CHANGE_FILES) or any(directory in file for directory in BUILD_CHANGE_DIRS):
+        tags.add('build')
+    elif file.endswith(CODE_CHANGE_FILES):
+        tags.add('code change')
+    elif file.endswith('.sql'):
+        tags.add('schema change')
+    if file.endswith('.json') and 'i18n/' in file:
+        tags.add('i18n')
+    return tags
 
 
 def get_changed_files(path: str, version: str) -> list[str]:
     repo_dir = os.path.join('/srv/mediawiki-staging', version, path)
-    changed_files = os.popen(f'git -C {repo_dir} --no-pager --git-dir={repo_dir}/.git diff --name-only HEAD@{{1}} HEAD 2> /dev/null').readlines()
-    return [file.strip() for file in changed_files]
+    # NUL separated and unquoted, non-ASCII names would otherwise come back C-quoted
+    changed_files = os.popen(f'git -C {repo_dir} --no-pager --git-dir={repo_dir}/.git -c core.quotePath=false diff --name-only -z --no-renames HEAD@{{1}} HEAD 2> /dev/null').read()
+    return [file for file in changed_files.split('\0') if file]
 
 
-def get_changed_files_type(path: str, version: str, change_type: str) -> set[str]:
-    tag_map = get_change_tag_map()
-    changed_files = get_changed_files(path, version)
-    files = set()
-    for file in changed_files:
-        for regex, tag in tag_map.items():
-            if tag != change_type:
-                continue
-            if regex.match(file):
-                files.add(file)
+def get_cached_changed_files(path: str, version: str) -> list[str]:
+    key = (path, version)
+    if key not in _changed_files:
+        _changed_files[key] = get_changed_files(path, version)
+    return _changed_files[key]
+
+
+def get_change_index(path: str, version: str) -> dict[str, set[str]]:
+    key = (path, version)
+    if key not in _change_index:
+        index: dict[str, set[str]] = {tag: set() for tag in CHANGE_TAGS}
+        for file in get_cached_changed_files(path, version):
+            for tag in classify_change(file):
+                index[tag].add(file)
+        _change_index[key] = index
+    return _change_index[key]
+
+
+def clear_change_index(path: str | None = None, version: str | None = None) -> None:
+    if path is None or version is None:
+        _change_index.clear()
+        _changed_files.clear()
+    else:
+        _change_index.pop((path, version), None)
+        _changed_files.pop((path, version), None)
+
+
+def get_incremental_file_list(path: str, version: str) -> list[str] | None:
+    files = get_cached_changed_files(path, version)
+    if not files:
+        return None
+    staging_path = _get_staging_path(path, version)
+    for file in files:
+        # a submodule bump shows up as a directory, only a full sync picks up its contents
+        if os.path.isdir(os.path.join(staging_path, file)):
+            return None
     return files
 
 
-def get_change_tags(path: str, version: str) -> set[str]:
-    tag_map = get_change_tag_map()
-    changed_files = get_changed_files(path, version)
-    tags = set()
-    for file in changed_files:
-        for regex, tag in tag_map.items():
-            if regex.match(file):
-                tags.add(tag)
-    return tags
+def write_file_list(files: list[str]) -> str:
+    fd, filelist = tempfile.mkstemp(prefix='mwdeploy-', suffix='.list')
+    with os.fdopen(fd, 'w') as listfile:
+        listfile.write(''.join(f'{file}\n' for file in files))
+    # rsync reads the list as the deploy user
+    os.chmod(filelist, 0o644)
+    atexit.register(_remove_file_list, filelist)
+    return filelist
+
 
+def _remove_file_list(filelist: str) -> None:
+    with suppress(OSError):
+        os.remove(filelist)
 
-def run_command(cmd: str) -> int:
+
+def get_changed_files_type(path: str, version: str, change_type: str) -> set[str]:
+    return set(get_change_index(path, version).get(change_type, set()))
+
+
+def get_change_tags(path: str, version: str) -> set[str]:
+    return {tag for tag, files in get_change_index(path, version).items() if files}
+
+
+def get_incoming_files(path: str, version: str) -> list[str]:
+    # what merging the fetched upstream would change, without touching the working tree
+    repo_dir = _get_staging_path(path, version)
+    incoming_files = os.popen(f'git -C {repo_dir} --no-pager -c core.quotePath=false diff --name-only -z HEAD...@{{u}} 2> /dev/null').read()
+    return [file for file in incoming_files.split('\0') if file]
+
+
+def _run_repo_command(repo: str, version: str, name: str, cmd: str, force: bool = False) -> PullResult:
+    with trace_span(name, category='git', repo=repo, version=version):
+        process = os.popen(cmd)
+        output = process.read().strip()
+        status = process.close()
+    clear_change_index(repo, version)
+    exitcode = 0
+    if status and not force:
+        exitcode = os.waitstatus_to_exitcode(status)
+    return {'repo': repo, 'ec': exitcode, 'output': output}
+
+
+def _map_repos(function: Callable[[str], PullResult], repos: list[str], jobs: int = 1) -> list[PullResult]:
+    if jobs > 1 and len(repos) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(inherit_output(function), repos))
+    return [function(repo) for repo in repos]
+
+
+def confirm_schema_changes(changes: dict[str, list[str]], version: str) -> set[str]:
+    # one prompt for every incoming schema change, returns the repositories held back
+    print('WARNING: upgrade contains schema changes.')
+    for repo, files in changes.items():
+        for file in files:
+            print(f'/srv/mediawiki-staging/{version}/{repo}/{file}')
+    try:
+        answer = input('Type Y to merge them all, or the names of the ones to merge (comma separated): ').strip()
+    except KeyboardInterrupt:
+        print('Operation aborted by user, nothing was merged')
+        sys.exit(1)
+    if answer.upper() == 'Y':
+        return set()
+    approved = {name.strip() for name in answer.split(',')}
+    return {repo for repo in changes if os.path.basename(repo) not in approved}
+
+
+def upgrade_repos(repos: list[str], version: str, submodules: set[str] | None = None, force: bool = False, jobs: int = 1, dry_run: bool = False, confirm: bool = True) -> tuple[list[PullResult], set[str], list[str]]:
+    # fetch everything, settle every schema change at once, then fast-forward what was approved
+    # returns the merge results, the repositories held back and the approved schema files
+    if dry_run:
+        print(f'Dry run: not pulling {len(repos)} repositories, planning them as upgraded.')
+        return [{'repo': repo, 'ec': 0, 'output': ''} for repo in repos], set(), []
+    with trace_span('fetch repositories', version=version, repos=len(repos)):
+        fetched = _map_repos(lambda repo: _run_repo_command(repo, version, 'git fetch', _construct_git_fetch(repo, version=version), force), repos, jobs)
+    failed = {result['repo']: result for result in fetched if result['ec'] != 0}
+    changes = {}
+    for repo in repos:
+        if repo not in failed:
+            files = sorted(file for file in get_incoming_files(repo, version) if 'schema change' in classify_change(file))
+            if files:
+                changes[repo] = files
+    heldback = confirm_schema_changes(changes, version) if confirm and changes else set()
+    with trace_span('merge repositories', version=version, repos=len(repos)):
+        merged = _map_repos(lambda repo: _run_repo_command(repo, version, 'git merge', _construct_git_merge(repo, submodules=repo in (submodules or set()), version=version), force), [repo for repo in repos if repo not in failed and repo not in heldback], jobs)
+    results = {result['repo']: result for result in merged}
+    results.update(failed)
+    counts = {'upgraded': 0, 'up to date': 0, 'failed': 0}
+    for result in results.values():
+        counts[get_pull_status(result)] += 1
+    print(f'Pulled {len(results)} repositories: {counts["upgraded"]} upgraded, {counts["up to date"]} up to date, {counts["failed"]} failed, {len(heldback)} held back.')
+    approved = [f'/srv/mediawiki-staging/{version}/{repo}/{file}' for repo, files in changes.items() if confirm and repo not in heldback for file in files]
+    return [results[repo] for repo in repos if repo in results], heldback, approved
+
+
+def get_pull_status(result: PullResult, force_upgrade: bool = False) -> str:
+    if result['ec'] != 0:
+        return 'failed'
+    if force_upgrade or result['output'] != 'Already up to date.':
+        return 'upgraded'
+    return 'up to date'
+
+
+def _get_command_category(cmd: str) -> str:
+    for category in ('composer', 'rsync', 'git', 'php', 'puppet'):
+        if f'{category} ' in cmd:
+            return category
+    return 'command'
+
+
+def run_command(cmd: str, cwd: str | None = None) -> int:
     start = time.time()
     print(f'Execute: {cmd}')
-    ec = os.system(cmd)
+    with trace_span(_get_command_category(cmd), category='command', cmd=cmd) as span:
+        if getattr(_output, 'prefix', ''):
+            # inside a version pipeline, route output through print so it gets the version prefix
+            with subprocess.Popen(cmd, shell=True, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as process:
+                for line in process.stdout or []:
+                    print(line, end='')
+            ec = process.returncode
+        elif cwd:
+            ec = os.system(f'cd {cwd} && {cmd}')
+        else:
+            ec = os.system(cmd)
+        span['ec'] = ec
     print(f'Completed ({ec}) in {str(int(time.time() - start))}s!')
     return ec
 
 
+def run_commands_parallel(cmds: list[str]) -> list[int]:
+    with ThreadPoolExecutor(max_workers=max(len(cmds), 1)) as executor:
+        return list(executor.map(inherit_output(run_command), cmds))
+
+
+def add_step(plan: dict[str, DeployStep], phase: str, description: str, action: Callable[[], list[int]], deps: list[str]) -> str:
+    name = f'{phase}-{sum(step["phase"] == phase for step in plan.values()) + 1}'
+    plan[name] = {'phase': phase, 'description': description, 'action': action, 'deps': list(deps)}
+    return name
+
+
+def add_command_step(plan: dict[str, DeployStep], phase: str, cmd: str, deps: list[str], cwd: str | None = None, inputs: StepInputs | None = None) -> str:
+    def action() -> list[int]:
+        return [run_command(cmd, cwd=cwd)]
+
+    if inputs:
+        return add_step(plan, phase, cmd, partial(run_fingerprinted, f'cd {cwd} && {cmd}' if cwd else cmd, action, inputs), deps)
+    return add_step(plan, phase, cmd, action, deps)
+
+
+def print_plan(plan: dict[str, DeployStep]) -> None:
+    print(f'DEPLOY PLAN ({len(plan)} steps):')
+    for name, step in plan.items():
+        after = f' (after {", ".join(step["deps"])})' if step['deps'] else ''
+        print(f'{name}{after}: {step["description"]}')
+
+
+def run_step(name: str, step: DeployStep) -> list[int]:
+    # one span per step, so --trace still shows the stage, rsync, postinstall, rebuild and remote phases
+    with trace_span(name, phase=step['phase']):
+        return step['action']()
+
+
+def execute_plan(plan: dict[str, DeployStep], jobs: int = 1, completed: dict[str, str] | None = None, record: Callable[[str], None] | None = None) -> dict[str, list[int]]:
+    # steps start in plan order once their dependencies succeeded, nothing new starts after a failure
+    results: dict[str, list[int]] = {}
+    pending = list(plan)
+    running: dict[Future, str] = {}
+    failed = False
+    for name in list(pending):
+        # a resumed step is only skipped if everything it depends on was skipped too
+        if completed and completed.get(name) == plan[name]['description'] and all(dep in results for dep in plan[name]['deps']):
+            print(f'Skipping {name}: completed before resume')
+            results[name] = [0]
+            pending.remove(name)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            if not failed:
+                for name in list(pending):
+                    if len(running) >= max(jobs, 1):
+                        break
+                    if all(dep in results and not non_zero_code(results[dep], leave=False) for dep in plan[name]['deps']):
+                        pending.remove(name)
+                        running[executor.submit(inherit_output(run_step), name, plan[name])] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                failed = failed or non_zero_code(results[name], leave=False)
+                if record and not non_zero_code(results[name], leave=False):
+                    record(name)
+    return results
+
+
+def get_git_head(path: str) -> str:
+    return os.popen(f'git -C {path} rev-parse HEAD 2>/dev/null').read().strip()
+
+
+def get_staging_heads(paths: list[str]) -> dict[str, str]:
+    return {path: get_git_head(path) for path in sorted(set(paths))}
+
+
+def get_journal_file(args: argparse.Namespace, version: str = '') -> str:
+    params = {key: value for key, value in vars(args).items() if key not in JOURNAL_IGNORED_ARGS}
+    key = hashlib.sha1(json.dumps([version, params], sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(JOURNAL_DIR, f'{key}.json')
+
+
+def load_journal(path: str, heads: dict[str, str]) -> DeployJournal:
+    journal = _load_cache_file(path)
+    if not journal.get('completed'):
+        print('No interrupted deploy to resume, starting from the beginning.')
+    elif journal.get('heads') != heads:
+        print('Staging changed since the interrupted deploy, starting from the beginning.')
+    else:
+        print(f'Resuming deploy, {len(journal["completed"])} completed steps will be skipped.')
+        return {'heads': heads, 'upgraded': journal.get('upgraded', []), 'completed': journal['completed']}
+    return {'heads': heads, 'upgraded': journal.get('upgraded', []), 'completed': {}}
+
+
+def record_journal_step(path: str, journal: DeployJournal, plan: dict[str, DeployStep], name: str) -> None:
+    journal['completed'][name] = plan[name]['description']
+    # only stage steps move staging heads, rescan once they are all done
+    # a deploy interrupted during stage then no longer matches and starts over, which is safe
+    if plan[name]['phase'] == 'stage' and all(step in journal['completed'] for step in plan if plan[step]['phase'] == 'stage'):
+        journal['heads'] = get_staging_heads(list(journal['heads']))
+    _save_cache_file(path, dict(journal))
+
+
 def non_zero_code(ec: list[int], nolog: bool = True, leave: bool = True) -> bool:
     for code in ec:
         if code != 0:
@@ -175,12 +767,18 @@ def non_zero_code(ec: list[int], nolog: bool = True, leave: bool = True) -> bool
     return False
 
 
-def check_up(nolog: bool, Debug: str | None = None, Host: str | None = None, domain: str = 'meta.miraheze.org', verify: bool = True, force: bool = False, port: int = 443) -> bool:
-    if verify is False:
-        os.environ['PYTHONWARNINGS'] = 'ignore:Unverified HTTPS request'
-    if not Debug and not Host:
-        raise Exception('Host or Debug must be specified')
+@cache
+def get_canary_session() -> requests.Session:
+    # one pool shared by every canary check, sized for probing the whole fleet at once
+    retries = Retry(total=CANARY_RETRIES, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=['GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(get_environment_info()['servers']) + 1, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
+
+def _canary_request(Debug: str | None = None, Host: str | None = None, domain: str = 'meta.miraheze.org', verify: bool = True, port: int = 443) -> tuple[str, requests.Response | None, float]:
     headers = {}
     if Debug:
         server = f'{Debug}.wikitide.net'
@@ -197,20 +795,40 @@ def check_up(nolog: bool, Debug: str | None = None, Host: str | None = None, dom
         domain = 'localhost'
         headers['host'] = f'{Host}'
         location = f'{Host}@{domain}'
-    up = False
     if port == 443:
         proto = 'https://'
     else:
         proto = 'http://'
-    req = requests.get(f'{proto}{domain}:{port}/w/api.php?action=query&meta=siteinfo&formatversion=2&format=json', headers=headers, verify=verify)
-    if req.status_code == 200 and 'miraheze' in req.text and (Debug is None or Debug in req.headers['X-Served-By']):
-        up = True
+    start = time.time()
+    try:
+        req = get_canary_session().get(f'{proto}{domain}:{port}/w/api.php?action=query&meta=siteinfo&formatversion=2&format=json', headers=headers, verify=verify, timeout=CANARY_TIMEOUT)
+    except requests.RequestException as e:
+        print(f'Canary request to {location} failed: {e}')
+        return location, None, time.time() - start
+    return location, req, time.time() - start
+
+
+def _canary_ok(req: requests.Response | None, Debug: str | None = None) -> bool:
+    return req is not None and req.status_code == 200 and 'miraheze' in req.text and (Debug is None or Debug in req.headers.get('X-Served-By', ''))
+
+
+def check_up(nolog: bool, Debug: str | None = None, Host: str | None = None, domain: str = 'meta.miraheze.org', verify: bool = True, force: bool = False, port: int = 443) -> bool:
+    if verify is False:
+        os.environ['PYTHONWARNINGS'] = 'ignore:Unverified HTTPS request'
+    if not Debug and not Host:
+        raise Exception('Host or Debug must be specified')
+
+    with trace_span('canary', category='canary', server=Debug or Host) as span:
+        location, req, _ = _canary_request(Debug=Debug, Host=Host, domain=domain, verify=verify, port=port)
+        up = _canary_ok(req, Debug)
+        span['up'] = up
     if not up:
-        print(f'Status: {req.status_code}')
-        print(f'Text: {"miraheze" in req.text} \n {req.text}')
-        if 'X-Served-By' not in req.headers:
-            req.headers['X-Served-By'] = 'None'
-        print(f'Debug: {(Debug is None or Debug in req.headers["X-Served-By"])}')
+        if req is not None:
+            print(f'Status: {req.status_code}')
+            print(f'Text: {"miraheze" in req.text} \n {req.text}')
+            if 'X-Served-By' not in req.headers:
+                req.headers['X-Served-By'] = 'None'
+            print(f'Debug: {(Debug is None or Debug in req.headers["X-Served-By"])}')
         if force:
             print(f'Ignoring canary check error on {location} due to --force')
         else:
@@ -224,50 +842,644 @@ def check_up(nolog: bool, Debug: str | None = None, Host: str | None = None, dom
     return up
 
 
-def remote_sync_file(time: str, serverlist: list[str], path: str, envinfo: Environment, nolog: bool, recursive: bool = True, force: bool = False) -> int:
-    print(f'Start {path} deploys.')
+def probe_servers(servers: list[str], domain: str, verify: bool = True, jobs: int = 0) -> list[ProbeResult]:
+    def probe(server: str) -> ProbeResult:
+        _, req, latency = _canary_request(Debug=server, domain=domain, verify=verify)
+        return {'server': server, 'up': _canary_ok(req, server), 'status': req.status_code if req is not None else None, 'latency': latency}
+
+    with ThreadPoolExecutor(max_workers=jobs or len(servers) or 1) as executor:
+        return list(executor.map(probe, servers))
+
+
+def print_probe_table(results: list[ProbeResult]) -> None:
+    print(f'{"SERVER":<12} {"STATUS":<8} {"LATENCY":>9}')
+    for result in results:
+        status = 'UP' if result['up'] else f'DOWN ({result["status"]})'
+        print(f'{result["server"]:<12} {status:<8} {result["latency"] * 1000:>7.0f}ms')
+
+
+def _hash_file(path: str) -> str:
+    if os.path.islink(path):
+        return hashlib.sha1(os.readlink(path).encode()).hexdigest()
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_manifest_file(path: str) -> str:
+    return os.path.join(MANIFEST_DIR, f'{hashlib.sha1(path.encode()).hexdigest()}.json')
+
+
+def build_manifest(path: str) -> dict[str, ManifestEntry]:
+    # files whose size and mtime match the previous manifest keep their hash
+    previous: dict[str, ManifestEntry] = _load_cache_file(_get_manifest_file(path))
+    if os.path.isdir(path):
+        files = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    else:
+        files = [path]
+    manifest: dict[str, ManifestEntry] = {}
+    for file in files:
+        stat = os.lstat(file)
+        relpath = os.path.relpath(file, path)
+        entry = previous.get(relpath)
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': _hash_file(file)}
+        manifest[relpath] = entry
+    _save_cache_file(_get_manifest_file(path), manifest)
+    return manifest
+
+
+def get_manifest_digest(manifest: dict[str, ManifestEntry]) -> str:
+    digest = hashlib.sha1()
+    for relpath in sorted(manifest):
+        digest.update(f'{relpath}\0{manifest[relpath]["size"]}\0{manifest[relpath]["sha1"]}\n'.encode())
+    return digest.hexdigest()
+
+
+def get_path_digest(path: str) -> str | None:
+    try:
+        return get_manifest_digest(build_manifest(path))
+    except OSError as e:
+        print(f'Unable to build manifest for {path}: {e}')
+        return None
+
+
+@contextmanager
+def _locked_file(path: str) -> Iterator[None]:
+    # serialises read-modify-write of a file shared between deployers
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(f'{path}.lock', os.O_RDONLY | os.O_CREAT, 0o664)
+    try:
+        # explicit, the umask would otherwise keep the other deployers from writing here.
+        # only the owner may chmod, whoever created them already did
+        with suppress(PermissionError):
+            os.chmod(directory, 0o2775)
+        with suppress(PermissionError):
+            os.fchmod(fd, 0o664)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _is_under(name: str, path: str) -> bool:
+    return name.rstrip('/') == path.rstrip('/') or name.startswith(f'{path.rstrip("/")}/')
+
+
+def get_pushed_paths(pushed: dict, server: str, path: str) -> list[str]:
+    return [name for name in pushed.get(server, {}) if _is_under(name, path)]
+
+
+def record_pushed_manifest(path: str, digest: str | None, servers: list[str]) -> bool:
+    # no digest forgets path and everything below it, the servers no longer hold a known tree
+    try:
+        with _locked_file(PUSHED_MANIFEST_FILE):
+            pushed = _load_cache_file(PUSHED_MANIFEST_FILE)
+            for server in servers:
+                for name in get_pushed_paths(pushed, server, path):
+                    del pushed[server][name]
+                if digest:
+                    pushed.setdefault(server, {})[path] = digest
+            return _save_cache_file(PUSHED_MANIFEST_FILE, pushed, mode=0o664)
+    except OSError as e:
+        print(f'Unable to update {PUSHED_MANIFEST_FILE}: {e}')
+        return False
+
+
+def get_inputs_fingerprint(files: list[str]) -> str:
+    digest = hashlib.sha1()
+    for file in sorted(set(files)):
+        digest.update(f'{file}\0{_hash_file(file) if os.path.exists(file) else "missing"}\n'.encode())
+    return digest.hexdigest()
+
+
+def get_input_files(patterns: list[str]) -> list[str]:
+    # directories stand for every file below them, patterns without a match are fingerprinted as missing
+    files = []
+    for pattern in patterns:
+        for match in glob.glob(pattern, recursive=True) or [pattern]:
+            if os.path.isdir(match):
+                files += [os.path.join(root, name) for root, _, names in os.walk(match) for name in names]
+            else:
+                files.append(match)
+    return files
+
+
+def get_step_fingerprint(inputs: StepInputs) -> str:
+    digest = hashlib.sha1(get_inputs_fingerprint(get_input_files(inputs['inputs'])).encode())
+    for repo in sorted({match for pattern in inputs['repos'] for match in glob.glob(pattern)}):
+        digest.update(f'{repo}\0{get_git_head(repo)}\n'.encode())
+    for tree in sorted(inputs['trees']):
+        digest.update(f'{tree}\0{get_path_digest(tree)}\n'.encode())
+    return digest.hexdigest()
+
+
+def run_fingerprinted(key: str, action: Callable[[], list[int]], inputs: StepInputs) -> list[int]:
+    if all(os.path.exists(output) for output in inputs['outputs']) and _load_cache_file(FINGERPRINT_FILE).get(key) == get_step_fingerprint(inputs):
+        print(f'Skipping {key}: inputs unchanged since its last successful run')
+        return [0]
+    ec = action()
+    if not non_zero_code(ec, leave=False):
+        # taken afterwards as some steps rewrite their own inputs (composer.lock)
+        fingerprint = get_step_fingerprint(inputs)
+        try:
+            with _locked_file(FINGERPRINT_FILE):
+                _save_cache_file(FINGERPRINT_FILE, {**_load_cache_file(FINGERPRINT_FILE), key: fingerprint}, mode=0o664)
+        except OSError as e:
+            print(f'Unable to update {FINGERPRINT_FILE}: {e}')
+    return ec
+
+
+def forget_fingerprints(path: str) -> None:
+    # every step run against the tree at path, so --rollback never leaves one looking up to date
+    try:
+        with _locked_file(FINGERPRINT_FILE):
+            fingerprints = _load_cache_file(FINGERPRINT_FILE)
+            _save_cache_file(FINGERPRINT_FILE, {key: value for key, value in fingerprints.items() if path not in key}, mode=0o664)
+    except OSError as e:
+        print(f'Unable to update {FINGERPRINT_FILE}: {e}')
+
+
+def get_composer_inputs(path: str) -> StepInputs:
+    # composer.local.json merges the extension and skin composer.json files in
+    files = ['composer.json', 'composer.local.json', 'composer.lock', 'vendor/composer/installed.json', 'extensions/*/composer.json', 'skins/*/composer.json']
+    return {'inputs': [os.path.join(path, file) for file in files], 'repos': [], 'trees': [], 'outputs': [os.path.join(path, 'vendor')]}
+
+
+def get_sync_targets(serverlist: list[str]) -> list[str]:
+    targets = []
     for server in serverlist:
-        if HOSTNAME != server.split('.')[0]:
-            print(f'Deploying {path} to {server}.')
-            ec = run_command(_construct_rsync_command(time=time, local=False, dest=path, server=server, recursive=recursive))
-            check_up(Debug=server, force=force, domain=envinfo['wikiurl'], nolog=nolog)
-            print(f'Deployed {path} to {server}.')
-        else:
-            return 0
-    print(f'Finished {path} deploys.')
+        if HOSTNAME == server.split('.')[0]:
+            break
+        targets.append(server)
+    return targets
+
+
+def get_ssh_command(multiplex: bool = True) -> str:
+    command = 'ssh -i /srv/mediawiki-staging/deploykey'
+    if not multiplex:
+        command += ' -o ControlPath=none'
+    elif _ssh_control_path:
+        command += f' -o ControlMaster=auto -o ControlPath={_ssh_control_path} -o ControlPersist=600'
+    return command
+
+
+def start_ssh_multiplexing(servers: list[str]) -> None:
+    # one master connection per server, every later ssh/rsync to it reuses the session
+    global _ssh_control_path
+    _ssh_control_path = f'/tmp/mwdeploy-{os.getpid()}-%C'
+    with trace_span('ssh setup', servers=len(servers)):
+        run_commands_parallel([f'sudo -u {DEPLOYUSER} {get_ssh_command()} -fN {DEPLOYUSER}@{server}.wikitide.net' for server in servers])
+    atexit.register(stop_ssh_multiplexing, servers)
+
+
+def stop_ssh_multiplexing(servers: list[str]) -> None:
+    global _ssh_control_path
+    if not _ssh_control_path:
+        return
+    for server in servers:
+        os.system(f'sudo -u {DEPLOYUSER} ssh -o ControlPath={_ssh_control_path} -O exit {DEPLOYUSER}@{server}.wikitide.net 2> /dev/null')
+    _ssh_control_path = None
+
+
+def start_relay_agent() -> None:
+    # a private agent holding only the relay key, its socket is passed to the relaying ssh explicitly
+    global _relay_agent_socket
+    agent_socket = f'/tmp/mwdeploy-{os.getpid()}-agent'
+    agent = subprocess.Popen(['sudo', '-u', DEPLOYUSER, 'ssh-agent', '-D', '-a', agent_socket, '-t', str(RELAY_AGENT_LIFETIME)], stdout=subprocess.DEVNULL)
+    atexit.register(stop_relay_agent, agent)
+    for _ in range(50):
+        if os.path.exists(agent_socket):
+            break
+        time.sleep(0.1)
+    if run_command(f'sudo -u {DEPLOYUSER} env SSH_AUTH_SOCK={agent_socket} ssh-add -q {RELAY_KEY}') != 0:
+        print(f'Could not load {RELAY_KEY} into an ssh agent, relaying servers would have no credentials.')
+        sys.exit(1)
+    _relay_agent_socket = agent_socket
+
+
+def stop_relay_agent(agent: subprocess.Popen) -> None:
+    global _relay_agent_socket
+    agent.terminate()
+    _relay_agent_socket = None
+
+
+def count_files(path: str) -> int:
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def parse_rsync_progress(line: str) -> RsyncProgress | None:
+    # rsync --info=progress2: "  1,238,099  45%  146.38MB/s    0:00:12 (xfr#5, to-chk=12/60)"
+    match = RSYNC_PROGRESS_REGEX.match(line)
+    if not match:
+        return None
+    size, percent, rate, unit, eta, files = match.groups()
+    return {'transferred': int(size.replace(',', '')), 'percent': int(percent), 'rate': float(rate) * 1024 ** ' kMGT'.index(unit or ' '), 'eta': eta, 'files': int(files or 0)}
+
+
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return f'{size:.1f}{unit}'
+
+
+def format_bwlimit(bwlimit: int) -> str:
+    return f'{bwlimit} KiB/s bandwidth limit' if bwlimit else 'no bandwidth limit'
+
+
+def find_stragglers(transfers: list[TransferProgress], ratio: float) -> list[str]:
+    # transfers slower than ratio times the fleet median, once they had time to get going
+    if len(transfers) < 3 or not ratio:
+        return []
+    median = statistics.median(transfer['rate'] for transfer in transfers)
+    now = time.time()
+    return [transfer['server'] for transfer in transfers if not transfer['done'] and now - transfer['started'] >= STRAGGLER_GRACE and transfer['rate'] < median * ratio]
+
+
+def print_transfer_table(path: str, transfers: list[TransferProgress], stragglers: list[str]) -> None:
+    print(f'{path} transfers:')
+    print(f'{"SERVER":<12} {"DONE":>5} {"BYTES":>10} {"FILES":>7} {"RATE":>12} {"ETA":>8}')
+    for transfer in transfers:
+        status = ' DEFERRED' if transfer['deferred'] else ' STRAGGLER' if transfer['server'] in stragglers else ''
+        print(f'{transfer["server"]:<12} {transfer["percent"]:>4}% {format_bytes(transfer["transferred"]):>10} {transfer["files"]:>7} {format_bytes(transfer["rate"]) + "/s":>12} {transfer["eta"]:>8}{status}')
+
+
+def update_transfer(server: str, path: str, progress: ProgressConfig, update: RsyncProgress) -> bool:
+    # returns whether the transfer should be deferred as a straggler
+    global _transfers_shown
+    with _transfers_lock:
+        transfer = _transfers[(server, path)]
+        transfer.update(update)
+        transfers = [transfer for (_, synced), transfer in _transfers.items() if synced == path]
+        stragglers = find_stragglers(transfers, progress['straggler_ratio'])
+        defer = progress['defer'] and server in stragglers and any(not other['done'] and other['server'] != server for other in transfers)
+        transfer['deferred'] = defer
+        if defer or time.time() - _transfers_shown >= PROGRESS_INTERVAL:
+            _transfers_shown = time.time()
+            print_transfer_table(path, transfers, stragglers)
+    return defer
+
+
+def run_transfer(cmd: str, server: str, path: str, progress: ProgressConfig) -> int:
+    # like run_command, but follows rsync's progress output and stops stragglers when asked to defer them
+    start = time.time()
+    print(f'Execute: {cmd}')
+    with _transfers_lock:
+        _transfers[(server, path)] = {'server': server, 'transferred': 0, 'percent': 0, 'rate': 0.0, 'eta': '', 'files': 0, 'started': start, 'done': False, 'deferred': False}
+    with trace_span(_get_command_category(cmd), category='command', cmd=cmd) as span:
+        # text mode turns the carriage returns between progress updates into line breaks
+        with subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as process:
+            for line in process.stdout or []:
+                update = parse_rsync_progress(line)
+                if not update:
+                    print(line, end='')
+                elif update_transfer(server, path, progress, update):
+                    print(f'{server} is a straggler, deferring {path} until the other servers are done.')
+                    process.terminate()
+                    break
+        ec = process.returncode
+        with _transfers_lock:
+            _transfers[(server, path)]['done'] = True
+        span['ec'] = ec
+    print(f'Completed ({ec}) in {str(int(time.time() - start))}s!')
     return ec
 
 
+def is_deferred(server: str, path: str) -> bool:
+    with _transfers_lock:
+        return (server, path) in _transfers and _transfers[(server, path)]['deferred']
+
+
+def _sync_to_server(command: str, server: str, path: str, envinfo: Environment, nolog: bool, force: bool = False, progress: ProgressConfig | None = None) -> SyncResult:
+    start = time.time()
+    with trace_span(f'sync {server}', category='remote sync', path=path):
+        print(f'Deploying {path} to {server}.')
+        ec = run_transfer(command, server, path, progress) if progress else run_command(command)
+        if progress and is_deferred(server, path):
+            # the canary runs once the deferred sync is retried
+            return {'server': server, 'path': path, 'ec': ec, 'duration': time.time() - start}
+        check_up(Debug=server, force=force, domain=envinfo['wikiurl'], nolog=nolog)
+        print(f'Deployed {path} to {server}.')
+    return {'server': server, 'path': path, 'ec': ec, 'duration': time.time() - start}
+
+
+def plan_waves(servers: list[str], canaries: int, wave_size: int) -> list[list[str]]:
+    waves = [servers[:canaries]] + [servers[index:index + wave_size] for index in range(canaries, len(servers), wave_size)]
+    return [wave for wave in waves if wave]
+
+
+def plan_relay_round(pending: list[str], senders: list[str | None], fanout: int) -> dict[str, str | None]:
+    # every sender (None is the deploy host) takes the next fanout servers still waiting
+    servers = iter(pending)
+    return {server: sender for sender in senders for server in islice(servers, fanout)}
+
+
+def adjust_controller(controller: SyncController, throughput: float, latency: float) -> SyncController:
+    # AIMD: back off hard when live requests slow down, probe upwards gently while they don't
+    adjusted = controller.copy()
+    if latency > controller['latency_target']:
+        adjusted['workers'] = max(controller['workers'] // 2, 1)
+        # without a limit yet, start from what each transfer just achieved
+        current = controller['bwlimit'] or int(throughput / controller['workers'] / 1024)
+        adjusted['bwlimit'] = max(current // 2, controller['min_bwlimit'], 1)
+    else:
+        if controller['bwlimit']:
+            adjusted['bwlimit'] = controller['bwlimit'] + max(controller['bwlimit'] // 4, 1)
+            if controller['max_bwlimit']:
+                adjusted['bwlimit'] = min(adjusted['bwlimit'], controller['max_bwlimit'])
+            elif adjusted['bwlimit'] * 1024 * controller['workers'] > throughput * 2:
+                adjusted['bwlimit'] = 0  # the limit no longer holds the transfers back
+        # more transfers only while they still add throughput, the link is saturated otherwise
+        if throughput >= controller['throughput'] * 1.1:
+            adjusted['workers'] = min(controller['workers'] + 1, controller['max_workers'])
+    adjusted['throughput'] = throughput
+    return adjusted
+
+
+def check_health_gate(servers: list[str], domain: str, rollout: RolloutConfig) -> bool:
+    results = probe_servers(servers, domain)
+    print_probe_table(results)
+    error_rate = sum(not result['up'] for result in results) / len(results)
+    latency = max(result['latency'] for result in results)
+    passed = error_rate <= rollout['max_error_rate'] and latency <= rollout['max_latency']
+    print(f'Health gate {"passed" if passed else "FAILED"}: error rate {error_rate:.0%} (max {rollout["max_error_rate"]:.0%}), latency {latency:.2f}s (max {rollout["max_latency"]:.2f}s)')
+    return passed
+
+
+def remote_sync_file(time: bool | str, serverlist: list[str], path: str, envinfo: Environment, nolog: bool, recursive: bool = True, force: bool = False, parallel: int = 1, files_from: str | None = None, skip_unchanged: bool = False, archive_threshold: int = 0, rollout: RolloutConfig | None = None, release: ReleaseConfig | None = None, relay_fanout: int = 0, progress: ProgressConfig | None = None, controller: SyncController | None = None) -> list[SyncResult]:
+    print(f'Start {path} deploys.')
+    targets = get_sync_targets(serverlist)
+    results: list[SyncResult] = []
+    archive = False
+    if controller and not progress:
+        # the controller measures throughput from rsync's progress output
+        progress = {'straggler_ratio': 0.0, 'defer': False}
+    if release:
+        # path is a version tree: sync every changed path into a new release, then activate it
+        commands = {server: _construct_remote_release_command(time, path.rstrip('/'), release, server) for server in targets}
+    else:
+        if archive_threshold and recursive and not files_from and os.path.isdir(path):
+            # many small files: one tar stream beats rsync's per-file round trips
+            filecount = count_files(path)
+            archive = filecount >= archive_threshold
+            if archive:
+                print(f'Streaming {path} as an archive ({filecount} files).')
+        commands = {server: _construct_archive_command(path, server) if archive else _construct_rsync_command(time=time, local=False, dest=path, server=server, recursive=recursive, files_from=files_from, progress=progress is not None) for server in targets}
+    digest = get_path_digest(path) if skip_unchanged else None
+    pushed = _load_cache_file(PUSHED_MANIFEST_FILE)
+    if digest:
+        for server in list(targets):
+            if pushed.get(server, {}).get(path) == digest:
+                print(f'{path} unchanged on {server}. Skipping...')
+                results.append({'server': server, 'path': path, 'ec': 0, 'duration': 0.0})
+                targets.remove(server)
+    # forgotten before pushing, so no other deployer skips a server this push leaves half-updated
+    stale = [server for server in targets if get_pushed_paths(pushed, server, path)]
+    if stale and not record_pushed_manifest(path, None, stale):
+        print(f'Unable to forget the manifests last pushed for {path}, other deployers would skip the servers this changes. Not deploying it.')
+        sys.exit(1)
+
+    def sync_batch(servers: list[str], workers: int) -> list[SyncResult]:
+        if workers <= 1 or len(servers) <= 1:
+            return [_sync_to_server(commands[server], server, path, envinfo, nolog, force, progress) for server in servers]
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(inherit_output(_sync_to_server), commands[server], server, path, envinfo, nolog, force, progress) for server in servers]
+        try:
+            batch = [future.result() for future in futures]
+        except BaseException:
+            # a failed canary exits - don't start syncs to servers still queued
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return batch
+
+    def sync_measured(servers: list[str]) -> tuple[list[SyncResult], float]:
+        # probe the servers while they receive the sync, that's when live requests would suffer
+        latencies: list[float] = []
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            futures = [executor.submit(inherit_output(_sync_to_server), commands[server], server, path, envinfo, nolog, force, progress) for server in servers]
+            while wait(futures, timeout=CONTROLLER_PROBE_INTERVAL).not_done:
+                latencies += [result['latency'] for result in probe_servers(servers, envinfo['wikiurl'])]
+            return [future.result() for future in futures], max(latencies, default=0.0)
+
+    if relay_fanout and not release:
+        # servers that are up to date forward the tree, each round multiplies the servers reached by fanout + 1
+        senders: list[str | None] = [None]
+        pending = list(targets)
+        while pending:
+            assignment = plan_relay_round(pending, senders, relay_fanout)
+            for server, sender in assignment.items():
+                if sender:
+                    commands[server] = _construct_relay_command(time, path, sender, server, recursive=recursive, progress=progress is not None)
+            print(f'Relaying {path}: ' + ', '.join(f'{sender or HOSTNAME} -> {server}' for server, sender in assignment.items()))
+            batch = sync_batch(list(assignment), len(assignment))
+            results += batch
+            senders += [result['server'] for result in batch if result['ec'] == 0]
+            pending = pending[len(assignment):]
+    elif rollout and rollout['wave_size']:
+        waves = plan_waves(targets, rollout['canaries'], rollout['wave_size'])
+        for index, wave in enumerate(waves):
+            print(f'Deploying {path} to wave {index + 1}/{len(waves)}: {", ".join(wave)}')
+            results += sync_batch(wave, len(wave))
+            if index + 1 == len(waves):
+                break
+            deployed = [server for done in waves[:index + 1] for server in done]
+            if check_health_gate(deployed, envinfo['wikiurl'], rollout):
+                continue
+            if force:
+                print('Ignoring failed health gate due to --force')
+                continue
+            halted = [server for remaining in waves[index + 1:] for server in remaining]
+            message = f'/usr/local/bin/logsalmsg DEPLOY HALTED: Health gate failed for {path} after wave {index + 1}, not deployed to {",".join(halted)}'
+            if nolog:
+                print(message)
+            else:
+                os.system(message)
+            results += [{'server': server, 'path': path, 'ec': 3, 'duration': 0.0} for server in halted]
+            break
+    elif controller:
+        pending = list(targets)
+        while pending:
+            batch_servers, pending = pending[:controller['workers']], pending[controller['workers']:]
+            if not release and not archive:
+                for server in batch_servers:
+                    commands[server] = _construct_rsync_command(time=time, local=False, dest=path, server=server, recursive=recursive, files_from=files_from, progress=True, bwlimit=controller['bwlimit'])
+            print(f'Deploying {path} to {", ".join(batch_servers)} ({format_bwlimit(controller["bwlimit"])})')
+            batch, latency = sync_measured(batch_servers)
+            results += batch
+            with _transfers_lock:
+                transferred = sum(_transfers[(server, path)]['transferred'] for server in batch_servers if (server, path) in _transfers)
+            # the batch took as long as its slowest server
+            throughput = transferred / max(max(result['duration'] for result in batch), 0.001)
+            # updated in place so the next path starts where this one left off
+            controller.update(adjust_controller(controller, throughput, latency))
+            print(f'Batch throughput {format_bytes(throughput)}/s, canary latency {latency:.2f}s: next {controller["workers"]} at once, {format_bwlimit(controller["bwlimit"])}')
+    else:
+        results += sync_batch(targets, parallel)
+    if progress:
+        # stragglers were stopped so they didn't hold up the queue, finish them one at a time now
+        for index, result in enumerate(results):
+            if is_deferred(result['server'], path):
+                print(f'Retrying deferred {path} sync to {result["server"]}.')
+                results[index] = _sync_to_server(commands[result['server']], result['server'], path, envinfo, nolog, force, {**progress, 'defer': False})
+    if digest:
+        record_pushed_manifest(path, digest, [result['server'] for result in results if result['ec'] == 0])
+    print(f'Finished {path} deploys.')
+    return results
+
+
+def print_sync_summary(results: list[SyncResult]) -> None:
+    print('SYNC SUMMARY:')
+    for result in results:
+        print(f'{result["server"]}: {result["path"]} ({result["ec"]}) in {result["duration"]:.1f}s')
+
+
 def _get_staging_path(repo: str, version: str = '') -> str:
     if version and ('extensions/' in repo or 'skins/' in repo or repo == 'vendor'):
         return f'/srv/mediawiki-staging/{version}/{repo}'
 
-    return f'/srv/mediawiki-staging/{repos[repo]}/'
+    return f'/srv/mediawiki-staging/{get_repos()[repo]}/'
 
 
 def _get_deployed_path(repo: str) -> str:
-    return f'/srv/mediawiki/{repos[repo]}/'
+    return f'/srv/mediawiki/{get_repos()[repo]}/'
 
 
-def _construct_rsync_command(time: bool | str, dest: str, recursive: bool = True, local: bool = True, location: str | None = None, server: str | None = None) -> str:
-    if time:
+def _get_rsync_params(time: bool | str, recursive: bool = True, files_from: str | None = None, release: bool = False, progress: bool = False, bwlimit: int = 0) -> str:
+    if release:  # files are hardlinked to older releases, never write into them
+        params = '' if time else '--update'
+    elif time:
         params = '--inplace'
     else:
         params = '--update'
-    if recursive:
+    if files_from:  # only the listed files, removing those missing from the source
+        params = params + f' --files-from={files_from} --delete-missing-args'
+    elif recursive:
         params = params + ' -r --delete'
+    if progress:
+        params = params + ' --info=progress2'
+    if bwlimit:
+        params = params + f' --bwlimit={bwlimit}'
+    return params.strip()
+
+
+def _construct_rsync_command(time: bool | str, dest: str, recursive: bool = True, local: bool = True, location: str | None = None, server: str | None = None, files_from: str | None = None, release_dest: str | None = None, progress: bool = False, bwlimit: int = 0) -> str:
+    params = _get_rsync_params(time, recursive=recursive, files_from=files_from, release=bool(release_dest) or is_released_path(dest), progress=progress, bwlimit=bwlimit)
     if local:
         if location is None:
             raise Exception('Location must be specified for local rsync.')
-        return f'sudo -u {DEPLOYUSER} rsync {params} --exclude=".*" {location} {dest}'
+        return f'sudo -u {DEPLOYUSER} rsync {params} --exclude=".*" {location} {release_dest or dest}'
     if location is None:
         location = dest
     if location == dest and server:  # ignore location if not specified, if given must equal dest.
-        return f'sudo -u {DEPLOYUSER} rsync {params} -e "ssh -i /srv/mediawiki-staging/deploykey" {dest} {DEPLOYUSER}@{server}.wikitide.net:{dest}'
+        return f'sudo -u {DEPLOYUSER} rsync {params} -e "{get_ssh_command()}" {dest} {DEPLOYUSER}@{server}.wikitide.net:{release_dest or dest}'
     # a return None here would be dangerous - except and ignore R503 as return after Exception is not reachable
     raise Exception(f'Error constructing command. Either server was missing or {location} != {dest}')
 
 
+def _construct_relay_command(time: bool | str, path: str, source: str, server: str, recursive: bool = True, progress: bool = False) -> str:
+    # the updated server pushes on with the relay key, forwarded from mwdeploy's own agent.
+    # a multiplexed master forwards its own agent (none), so the hop opens a connection of its own
+    if _relay_agent_socket is None:
+        raise Exception('The relay agent must be started before relaying, see start_relay_agent().')
+    push = f'rsync {_get_rsync_params(time, recursive=recursive, release=is_released_path(path), progress=progress)} -e ssh {path} {DEPLOYUSER}@{server}.wikitide.net:{path}'
+    return f'sudo -u {DEPLOYUSER} env SSH_AUTH_SOCK={_relay_agent_socket} {get_ssh_command(multiplex=False)} -A {DEPLOYUSER}@{source}.wikitide.net {shlex.quote(push)}'
+
+
+def _construct_archive_unpack(target: str) -> str:
+    # unpack next to the live tree, then point its symlink at the new copy like a release switch
+    unpacked = f'{target}.mwdeploy-{RELEASE_ID}'
+    return (
+        f'rm -rf {unpacked} && mkdir -p {unpacked} && tar -xzf - -C {unpacked} && '
+        f'if [ -d {target} ] && [ ! -L {target} ]; then mv {target} {target}.mwdeploy-initial && ln -s {target}.mwdeploy-initial {target}; fi && '
+        f'previous=$(readlink {target} || true) && {_construct_release_switch(target, unpacked)} && '
+        f'if [ -n "$previous" ] && [ "$previous" != {unpacked} ]; then rm -rf "$previous"; fi'
+    )
+
+
+def _construct_archive_command(dest: str, server: str) -> str:
+    target = dest.rstrip('/')
+    return f'sudo -u {DEPLOYUSER} tar -C {target} -czf - . | sudo -u {DEPLOYUSER} {get_ssh_command()} {DEPLOYUSER}@{server}.wikitide.net {shlex.quote(_construct_archive_unpack(target))}'
+
+
+def get_releases_dir(root: str) -> str:
+    return f'{os.path.dirname(root)}/releases/{os.path.basename(root)}'
+
+
+def get_release_path(path: str, root: str, release: str) -> str:
+    return f'{get_releases_dir(root)}/{release}{path[len(root):]}'
+
+
+def is_released_path(path: str) -> bool:
+    # once deployed with --releases, a version tree shares its files with the retained releases,
+    # later deploys without --releases must not write through those hardlinks either
+    parts = path.split('/')
+    return path.startswith('/srv/mediawiki/') and len(parts) > 3 and bool(parts[3]) and os.path.isdir(get_releases_dir(f'/srv/mediawiki/{parts[3]}'))
+
+
+def _construct_release_prepare(root: str, release: str) -> str:
+    # the first release adopts the live tree, every later one starts as a hardlink copy of the active release
+    releases = get_releases_dir(root)
+    new = f'{releases}/{release}'
+    return (
+        f'mkdir -p {releases} && '
+        f'if [ -d {root} ] && [ ! -L {root} ]; then mv {root} {releases}/0-initial && ln -s {releases}/0-initial {root}; fi && '
+        f'if [ ! -d {new} ]; then rm -rf {new}.tmp && if [ -e {root} ]; then cp -al {root}/. {new}.tmp; else mkdir {new}.tmp; fi && mv {new}.tmp {new}; fi'
+    )
+
+
+def _construct_release_switch(root: str, target: str) -> str:
+    # rename() over the old symlink is atomic, readers see either release but never a mix
+    return f'ln -sfn {target} {root}.mwdeploy-link && mv -T {root}.mwdeploy-link {root}'
+
+
+def _construct_release_activate(root: str, release: str, keep: int) -> str:
+    releases = get_releases_dir(root)
+    prune = f'ls -1 {releases} | grep -v "\\.tmp$" | sort -r | tail -n +{keep + 1} | grep -vx "$(basename "$(readlink {root})")" | sed "s|^|{releases}/|" | xargs -r rm -rf'
+    return f'{_construct_release_switch(root, f"{releases}/{release}")} && {prune}'
+
+
+def _construct_release_rollback(root: str) -> str:
+    releases = get_releases_dir(root)
+    return (
+        f'current=$(basename "$(readlink {root})") && '
+        f'previous=$(ls -1 {releases} | grep -v "\\.tmp$" | sort | grep -B1 -x "$current" | head -n 1) && '
+        f'if [ -z "$previous" ] || [ "$previous" = "$current" ]; then echo "No release before $current to roll back to"; exit 1; fi && '
+        f'{_construct_release_switch(root, f"{releases}/$previous")} && echo "Rolled back to $previous"'
+    )
+
+
+def _construct_release_command(script: str, server: str | None = None) -> str:
+    if server:
+        return f'sudo -u {DEPLOYUSER} {get_ssh_command()} {DEPLOYUSER}@{server}.wikitide.net {shlex.quote(script)}'
+    return f'sudo -u {DEPLOYUSER} sh -c {shlex.quote(script)}'
+
+
+def _construct_remote_release_command(time: bool | str, root: str, release: ReleaseConfig, server: str) -> str:
+    commands = [_construct_release_command(_construct_release_prepare(root, release['release']), server)]
+    commands += [_construct_rsync_command(time=time, local=False, dest=path, server=server, files_from=release['files_from'].get(path), release_dest=get_release_path(path, root, release['release'])) for path in release['paths']]
+    commands.append(_construct_release_command(_construct_release_activate(root, release['release'], release['keep']), server))
+    return ' && '.join(commands)
+
+
+def _construct_upgrade_rsync(repo: str, version: str, time: bool | str, incremental: bool = False, release: str | None = None) -> tuple[str, str | None]:
+    location = f'/srv/mediawiki-staging/{version}/{repo}/'
+    dest = f'/srv/mediawiki/{version}/{repo}/'
+    release_dest = get_release_path(dest, f'/srv/mediawiki/{version}', release) if release else None
+    if incremental:
+        files = get_incremental_file_list(repo, version)
+        if files:
+            print(f'Syncing {len(files)} changed file(s) for {repo}')
+            filelist = write_file_list(files)
+            return _construct_rsync_command(time=time, location=location, dest=dest, files_from=filelist, release_dest=release_dest), filelist
+    return _construct_rsync_command(time=time, location=f'{location}*', dest=dest, release_dest=release_dest), None
+
+
 def _construct_git_pull(repo: str, submodules: bool = False, branch: str | None = None, quiet: bool = True, version: str = '') -> str:
     extrap = ' '
     if submodules:
@@ -284,6 +1496,18 @@ def _construct_git_pull(repo: str, submodules: bool = False, branch: str | None
     return f'sudo -u {DEPLOYUSER} git -C {_get_staging_path(repo, version)} pull{extrap}'
 
 
+def _construct_git_fetch(repo: str, version: str = '') -> str:
+    return f'sudo -u {DEPLOYUSER} git -C {_get_staging_path(repo, version)} fetch --quiet'
+
+
+def _construct_git_merge(repo: str, submodules: bool = False, version: str = '') -> str:
+    path = _get_staging_path(repo, version)
+    command = f'sudo -u {DEPLOYUSER} git -C {path} merge --ff-only @{{u}} 2> /dev/null'
+    if submodules:
+        command += f' && sudo -u {DEPLOYUSER} git -C {path} submodule update --init --recursive --quiet'
+    return command
+
+
 def _construct_git_reset_revert(repo: str, version: str = '') -> str:
     return f'sudo -u {DEPLOYUSER} git -C {_get_staging_path(repo, version)} reset --hard HEAD@{{1}}'
 
@@ -301,6 +1525,10 @@ def _construct_reset_mediawiki_run_puppet() -> str:
 
 
 def run(args: argparse.Namespace, start: float) -> None:  # pragma: no cover
+    if args.dry_run:
+        # a plan preview writes nothing to the server admin log
+        args.nolog = True
+
     loginfo = {}
     for arg in vars(args).items():
         if arg[1] is not None and arg[1] is not False:
@@ -322,7 +1550,7 @@ def run(args: argparse.Namespace, start: float) -> None:  # pragma: no cover
     if len(args.servers) > 1 and args.servers == get_environment_info()['servers']:
         loginfo['servers'] = 'all'
 
-    use_version = args.world or args.l10n or args.extension_list or args.reset_world or args.upgrade_extensions or args.upgrade_skins or args.upgrade_vendor
+    use_version = args.world or args.l10n or args.extension_list or args.reset_world or args.upgrade_extensions or args.upgrade_skins or args.upgrade_vendor or args.rollback
 
     if args.versions:
         if args.upgrade_extensions == get_valid_extensions(args.versions):
@@ -347,7 +1575,20 @@ def run(args: argparse.Namespace, start: float) -> None:  # pragma: no cover
     else:
         print(text)
 
-    exitcodes = run_process(args=args)
+    if args.trace:
+        start_trace()
+        # written on every exit so aborted deploys can be inspected too
+        atexit.register(write_trace, args.trace)
+
+    # a dry run only prints the plan, so it opens no connection to the fleet
+    if args.reuse_ssh and not args.dry_run and get_sync_targets(args.servers):
+        start_ssh_multiplexing(get_sync_targets(args.servers))
+    if args.relay_fanout and not args.dry_run and get_sync_targets(args.servers):
+        # fail before anything is deployed rather than on the first relayed hop
+        start_relay_agent()
+
+    with trace_span('run_process'):
+        exitcodes = run_process(args=args)
     failed = non_zero_code(ec=exitcodes, leave=False)
 
     fintext = f'finished deploy of "{str(loginfo)}" to {synced}'
@@ -360,9 +1601,20 @@ def run(args: argparse.Namespace, start: float) -> None:  # pragma: no cover
             print(fintext)
         sys.exit(1)
 
-    if use_version:
+    if use_version and args.parallel_versions and len(args.versions) > 1:
+        versioncodes = run_versions(args, args.versions)
+        exitcodes = [ec for codes in versioncodes.values() for ec in codes]
+        if non_zero_code(ec=exitcodes, leave=False):
+            fintext += f' - FAIL: {versioncodes}'
+            if not args.nolog:
+                os.system(f'/usr/local/bin/logsalmsg {fintext}')
+            else:
+                print(fintext)
+            sys.exit(1)
+    elif use_version:
         for version in args.versions:
-            exitcodes = run_process(args=args, version=version)
+            with trace_span('run_process', version=version):
+                exitcodes = run_process(args=args, version=version)
             failed = non_zero_code(ec=exitcodes, leave=False)
 
             if failed:
@@ -373,6 +1625,9 @@ def run(args: argparse.Namespace, start: float) -> None:  # pragma: no cover
                     print(fintext)
                 sys.exit(1)
 
+    if args.probe:
+        print_probe_table(probe_servers(args.servers, domain=get_environment_info()['wikiurl']))
+
     fintext += ' - SUCCESS'
     fintext += f' in {str(int(time.time() - start))}s'
     if not args.nolog:
@@ -381,19 +1636,108 @@ def run(args: argparse.Namespace, start: float) -> None:  # pragma: no cover
         print(fintext)
 
 
+class PrefixedOutput:
+    # sys.stdout stand-in prefixing each line written by a thread that set _output.prefix
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        prefix = getattr(_output, 'prefix', '')
+        if not prefix:
+            return self.stream.write(text)
+        *lines, _output.buffer = (getattr(_output, 'buffer', '') + text).split('\n')
+        with self.lock:
+            for line in lines:
+                self.stream.write(f'{prefix}{line}\n')
+        return len(text)
+
+    def flush(self) -> None:
+        if getattr(_output, 'prefix', '') and getattr(_output, 'buffer', ''):
+            self.write('\n')
+        self.stream.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+
+def run_versions(args: argparse.Namespace, versions: list[str]) -> dict[str, list[int]]:  # pragma: no cover
+    def pipeline(version: str) -> list[int]:
+        _output.prefix = f'[{version}] '
+        try:
+            with trace_span('run_process', version=version):
+                return run_process(args=args, version=version)
+        except SystemExit as e:
+            return [e.code if isinstance(e.code, int) else 1]
+        finally:
+            sys.stdout.flush()
+            _output.prefix = ''
+
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=len(versions)) as executor:
+            return dict(zip(versions, executor.map(pipeline, versions)))
+    finally:
+        sys.stdout = stdout
+
+
+def rollback_release(args: argparse.Namespace, version: str) -> list[int]:
+    envinfo = get_environment_info()
+    root = _get_deployed_path(version).rstrip('/')
+    script = _construct_release_rollback(root)
+    exitcodes: list[int] = []
+    if args.dry_run:
+        print(f'ROLLBACK PLAN for {root}:')
+        if HOSTNAME in args.servers:
+            print(_construct_release_command(script))
+        for server in get_sync_targets(args.servers):
+            print(_construct_release_command(script, server))
+        return exitcodes
+    # the servers go back to an older tree than the one last pushed to them, and steps run against it
+    forget_fingerprints(f'{root}/')
+    if not record_pushed_manifest(root, None, get_sync_targets(args.servers)):
+        print(f'Unable to forget the manifests last pushed for {root}, other deployers would skip the servers this rolls back. Not rolling back.')
+        sys.exit(1)
+    if HOSTNAME in args.servers:
+        port = int(args.port) if args.port else 443
+        exitcodes.append(run_command(_construct_release_command(script)))
+        non_zero_code(exitcodes, nolog=args.nolog)
+        exitcodes.append(0 if check_up(Debug=None, Host=envinfo['wikiurl'], verify=False, force=args.force, nolog=args.nolog, port=port) or args.force else 3)
+        non_zero_code(exitcodes, nolog=args.nolog)
+    with ThreadPoolExecutor(max_workers=max(args.parallel, 1)) as executor:
+        futures = [executor.submit(inherit_output(_sync_to_server), _construct_release_command(script, server), server, root, envinfo, args.nolog, args.force) for server in get_sync_targets(args.servers)]
+        results = [future.result() for future in futures]
+    if results:
+        print_sync_summary(results)
+    return exitcodes + [result['ec'] for result in results]
+
+
 def run_process(args: argparse.Namespace, version: str = '') -> list[int]:  # pragma: no cover
+    if args.rollback:
+        return rollback_release(args, version) if version else []
     envinfo = get_environment_info()
     options = {'config': args.config and not version, 'world': args.world and version, 'landing': args.landing and not version, 'errorpages': args.errorpages and not version}
     exitcodes = []
     rsyncpaths = []
     rsyncfiles = []
+    rsyncfilelists = {}  # type: dict[str, str]
     rsync = []
     rebuild = []
     postinstall = []
     stage = []
+    stepinputs = {}  # type: dict[str, StepInputs]
     newschema = []
     tagsinfo = []  # type: list[str]
-    warnings = {}
+    syncresults = []  # type: list[SyncResult]
+    plan = {}  # type: dict[str, DeployStep]
+    headpaths = []  # type: list[str]
+    upgraded = []  # type: list[str]
+    journalfile = get_journal_file(args, version)
+    release = RELEASE_ID if args.releases and version else None
+    releaseroot = _get_deployed_path(version).rstrip('/') if release else ''
+    # repos pulled by the interrupted deploy are up to date now but still need syncing
+    resumed = _load_cache_file(journalfile).get('upgraded', []) if args.resume else []
 
     if HOSTNAME in args.servers:
         if version:
@@ -419,131 +1763,70 @@ def run_process(args: argparse.Namespace, version: str = '') -> list[int]:  # pr
                         else:
                             continue
                     stage.append(_construct_git_pull(repo, branch=args.branch))
+                    headpaths.append(_get_staging_path(repo))
                 except KeyError:
                     print(f'Failed to pull {repo} due to invalid name')
 
         if version:
             if args.upgrade_vendor:
+                headpaths.append(_get_staging_path('vendor', version))
                 stage.append(_construct_git_reset_hard('vendor', version=version))
                 stage.append(_construct_git_pull('vendor', submodules=True, version=version))
                 if not args.world:
                     stage.append(f'sudo -u {DEPLOYUSER} http_proxy=http://bastion.fsslc.wtnet:8080 composer update --no-dev --quiet')
-                    rsync.append(_construct_rsync_command(time=args.ignore_time, location=f'/srv/mediawiki-staging/{version}/vendor/*', dest=f'/srv/mediawiki/{version}/vendor/'))
+                    rsync.append(_construct_rsync_command(time=args.ignore_time, location=f'/srv/mediawiki-staging/{version}/vendor/*', dest=f'/srv/mediawiki/{version}/vendor/', release_dest=get_release_path(f'/srv/mediawiki/{version}/vendor/', releaseroot, release) if release else None))
                     rsyncpaths.append(f'/srv/mediawiki/{version}/vendor/')
 
-            if args.upgrade_extensions:
-                for extension in args.upgrade_extensions:
-                    if not os.path.exists(_get_staging_path(f'extensions/{extension}', version)):
-                        print(f'{extension} does not exist for {version}. Skipping...')
+            to_upgrade = []
+            for kind, names in (('extensions', args.upgrade_extensions), ('skins', args.upgrade_skins)):
+                for name in names or []:
+                    if not os.path.exists(_get_staging_path(f'{kind}/{name}', version)):
+                        print(f'{name} does not exist for {version}. Skipping...')
                         continue
-                    process = os.popen(_construct_git_pull(f'extensions/{extension}', submodules=True, quiet=False, version=version))
-                    output = process.read().strip()
-                    status = process.close()
-                    exitcode = 0
-                    if status and not args.force:
-                        exitcode = os.waitstatus_to_exitcode(status)
+                    to_upgrade.append(f'{kind}/{name}')
+                    headpaths.append(_get_staging_path(f'{kind}/{name}', version))
+            if to_upgrade:
+                results, heldback, approved = upgrade_repos(to_upgrade, version, submodules={repo for repo in to_upgrade if repo.startswith('extensions/')}, force=args.force, jobs=args.jobs, dry_run=args.dry_run, confirm=not args.skip_schema_confirm)
+                newschema += approved
+                for repo in heldback:
+                    print(f'{os.path.basename(repo)} held back, its schema changes were not approved.')
+                for result in results:
+                    name = os.path.basename(result['repo'])
+                    exitcode = result['ec']
                     exitcodes.append(exitcode)
-                    if exitcode == 0 and (args.force_upgrade or output != 'Already up to date.'):
-                        print(f'Upgrading {extension}')
-                        for file in get_changed_files_type(f'extensions/{extension}', version, 'schema change'):
-                            if not args.skip_schema_confirm and extension not in warnings:
-                                warnings[extension] = True
-                                print('WARNING: upgrade contains schema changes.')
-                                try:
-                                    if input('Type Y to confirm: ').upper() != 'Y':
-                                        exitcodes.append(run_command(_construct_git_reset_revert(f'extensions/{extension}', version)))
-                                        print('reverted')
-                                        continue
-                                    newschema.append(f'/srv/mediawiki-staging/{version}/extensions/{extension}/{file}')
-                                except KeyboardInterrupt:
-                                    run_command(_construct_git_reset_revert(f'extensions/{extension}', version))
-                                    print('reverted')
-                                    if tagsinfo:
-                                        print('TAGS:')
-                                        for info in tagsinfo:
-                                            print(info)
-                                    if newschema:
-                                        print('WARNING: NEW SCHEMA CHANGES DETECTED:')
-                                        for schema in newschema:
-                                            print(schema)
-                                    print('Operation aborted by user')
-                                    sys.exit(1)
+                    status = get_pull_status(result, force_upgrade=args.force_upgrade)
+                    if status == 'up to date' and result['repo'] in resumed:
+                        status = 'upgraded'
+                    if status == 'upgraded':
+                        upgraded.append(result['repo'])
+                        print(f'Upgrading {name}')
                         if args.show_tags:
-                            tags = get_change_tags(f'extensions/{extension}', version)
+                            tags = get_change_tags(result['repo'], version)
                             if tags:
-                                tagsinfo.append(f'Tags for {extension}: {", ".join(sorted(tags))}')
+                                tagsinfo.append(f'Tags for {name}: {", ".join(sorted(tags))}')
                         if not args.world:
-                            rsync.append(_construct_rsync_command(time=args.ignore_time, location=f'/srv/mediawiki-staging/{version}/extensions/{extension}/*', dest=f'/srv/mediawiki/{version}/extensions/{extension}/'))
-                            rsyncpaths.append(f'/srv/mediawiki/{version}/extensions/{extension}/')
-                    elif exitcode == 0:
-                        print(f'{extension} already up to date. Skipping...')
+                            # HEAD@{1} is only this pull's diff if the pull actually moved HEAD
+                            pulled = get_pull_status(result) == 'upgraded'
+                            command, filelist = _construct_upgrade_rsync(result['repo'], version, args.ignore_time, incremental=args.incremental and pulled, release=release)
+                            rsync.append(command)
+                            rsyncpaths.append(f'/srv/mediawiki/{version}/{result["repo"]}/')
+                            if filelist:
+                                rsyncfilelists[f'/srv/mediawiki/{version}/{result["repo"]}/'] = filelist
+                    elif status == 'up to date':
+                        print(f'{name} already up to date. Skipping...')
                     else:
-                        print(f'Failed to upgrade {extension} (exit code: {exitcode}).')
+                        print(f'Failed to upgrade {name} (exit code: {exitcode}).')
 
-            if args.upgrade_skins:
-                for skin in args.upgrade_skins:
-                    if not os.path.exists(_get_staging_path(f'skins/{skin}', version)):
-                        print(f'{skin} does not exist for {version}. Skipping...')
-                        continue
-                    process = os.popen(_construct_git_pull(f'skins/{skin}', quiet=False, version=version))
-                    output = process.read().strip()
-                    status = process.close()
-                    exitcode = 0
-                    if status and not args.force:
-                        exitcode = os.waitstatus_to_exitcode(status)
-                    exitcodes.append(exitcode)
-                    if exitcode == 0 and (args.force_upgrade or output != 'Already up to date.'):
-                        print(f'Upgrading {skin}')
-                        for file in get_changed_files_type(f'skins/{skin}', version, 'schema change'):
-                            if not args.skip_schema_confirm and skin not in warnings:
-                                warnings[skin] = True
-                                print('WARNING: upgrade contains schema changes.')
-                                try:
-                                    if input('Type Y to confirm: ').upper() != 'Y':
-                                        exitcodes.append(run_command(_construct_git_reset_revert(f'skins/{skin}', version)))
-                                        print('reverted')
-                                        continue
-                                    newschema.append(f'/srv/mediawiki-staging/{version}/skins/{skin}/{file}')
-                                except KeyboardInterrupt:
-                                    run_command(_construct_git_reset_revert(f'skins/{skin}', version))
-                                    print('reverted')
-                                    if tagsinfo:
-                                        print('TAGS:')
-                                        for info in tagsinfo:
-                                            print(info)
-                                    if newschema:
-                                        print('WARNING: NEW SCHEMA CHANGES DETECTED:')
-                                        for schema in newschema:
-                                            print(schema)
-                                    print('Operation aborted by user')
-                                    sys.exit(1)
-                        if args.show_tags:
-                            tags = get_change_tags(f'skins/{skin}', version)
-                            if tags:
-                                tagsinfo.append(f'Tags for {skin}: {", ".join(sorted(tags))}')
-                        if not args.world:
-                            rsync.append(_construct_rsync_command(time=args.ignore_time, location=f'/srv/mediawiki-staging/{version}/skins/{skin}/*', dest=f'/srv/mediawiki/{version}/skins/{skin}/'))
-                            rsyncpaths.append(f'/srv/mediawiki/{version}/skins/{skin}/')
-                    elif exitcode == 0:
-                        print(f'{skin} already up to date. Skipping...')
-                    else:
-                        print(f'Failed to upgrade {skin} (exit code: {exitcode}).')
-
-        for cmd in stage:  # setup env, git pull etc
-            if 'composer' in cmd:
-                os.chdir(_get_staging_path(version))
-            exitcodes.append(run_command(cmd))
-        non_zero_code(exitcodes, nolog=args.nolog)
         for option in options:  # configure rsync & custom data for repos
             if options[option]:
                 if option == 'world':  # install steps for world
                     option = version
-                    os.chdir(_get_staging_path(version))
-                    exitcodes.append(run_command(f'sudo -u {DEPLOYUSER} http_proxy=http://bastion.fsslc.wtnet:8080 composer update --no-dev --quiet'))
+                    stage.append(f'sudo -u {DEPLOYUSER} http_proxy=http://bastion.fsslc.wtnet:8080 composer update --no-dev --quiet')
                     rebuild.append(f'sudo -u {DEPLOYUSER} MW_INSTALL_PATH=/srv/mediawiki-staging/{version} php {runner_staging}/srv/mediawiki-staging/{version}/extensions/MirahezeMagic/maintenance/rebuildVersionCache.php --save-gitinfo --version={version} --wiki={envinfo["wikidbname"]} --conf=/srv/mediawiki-staging/config/LocalSettings.php')
+                    stepinputs[rebuild[-1]] = {'inputs': [], 'repos': [f'/srv/mediawiki-staging/{version}', f'/srv/mediawiki-staging/{version}/extensions/*', f'/srv/mediawiki-staging/{version}/skins/*'], 'trees': [], 'outputs': [f'/srv/mediawiki/cache/{version}/gitinfo']}
                     rsyncpaths.append(f'/srv/mediawiki/cache/{version}/gitinfo/')
-                rsync.append(_construct_rsync_command(time=args.ignore_time, location=f'{_get_staging_path(option)}*', dest=_get_deployed_path(option)))
-        non_zero_code(exitcodes, nolog=args.nolog)
+                headpaths.append(_get_staging_path(option))
+                rsync.append(_construct_rsync_command(time=args.ignore_time, location=f'{_get_staging_path(option)}*', dest=_get_deployed_path(option), release_dest=get_release_path(_get_deployed_path(option), releaseroot, release) if release else None))
         if args.files and not version:  # specfic extra files
             files = str(args.files).split(',')
             for file in files:
@@ -555,30 +1838,49 @@ def run_process(args: argparse.Namespace, version: str = '') -> list[int]:  # pr
 
         if args.extension_list and version:  # when adding skins/exts
             rebuild.append(f'sudo -u {DEPLOYUSER} php {runner}ManageWiki:RebuildExtensionListCache --wiki={envinfo["wikidbname"]} --cachedir=/srv/mediawiki/cache/{version}')
+            stepinputs[rebuild[-1]] = {'inputs': [f'/srv/mediawiki/{version}/extensions/*/extension.json', f'/srv/mediawiki/{version}/skins/*/skin.json'], 'repos': [], 'trees': [], 'outputs': [f'/srv/mediawiki/cache/{version}/extension-list.json']}
 
-        for cmd in rsync:  # move staged content to live
-            exitcodes.append(run_command(cmd))
-        non_zero_code(exitcodes)
         if args.l10n and version:  # setup l10n
             lang = ''
             if args.lang:
                 lang = f'--lang={args.lang}'
 
             postinstall.append(f'sudo -u {DEPLOYUSER} php {runner}/srv/mediawiki/{version}/extensions/MirahezeMagic/maintenance/mergeMessageFileList.php --quiet --wiki={envinfo["wikidbname"]} --extensions-dir=/srv/mediawiki/{version}/extensions:/srv/mediawiki/{version}/skins --output /srv/mediawiki/config/ExtensionMessageFiles-{version}.php')
-            rebuild.append(f'sudo -u {DEPLOYUSER} php {runner}/srv/mediawiki/{version}/maintenance/rebuildLocalisationCache.php {lang} --quiet --wiki={envinfo["wikidbname"]}')
-
-        for cmd in postinstall:  # cmds to run after rsync & install (like mergemessage)
-            exitcodes.append(run_command(cmd))
-        non_zero_code(exitcodes, nolog=args.nolog)
-        for cmd in rebuild:  # update ext list + l10n
-            exitcodes.append(run_command(cmd))
-        non_zero_code(exitcodes, nolog=args.nolog)
+            stepinputs[postinstall[-1]] = {'inputs': [f'/srv/mediawiki/{version}/extensions/*/extension.json', f'/srv/mediawiki/{version}/skins/*/skin.json'], 'repos': [], 'trees': [], 'outputs': [f'/srv/mediawiki/config/ExtensionMessageFiles-{version}.php']}
+            # messages can live anywhere a manifest's MessagesDirs or ExtensionMessagesFiles point, so key on the
+            # whole deployed tree the rebuild reads, which a rollback or an aborted sync changes without staging
+            stepinputs['l10n'] = {'inputs': [f'/srv/mediawiki/config/ExtensionMessageFiles-{version}.php'], 'repos': [], 'trees': [f'/srv/mediawiki/{version}/'], 'outputs': [f'/srv/mediawiki/cache/{version}/l10n']}
+            if args.l10n_shards <= 1:
+                rebuild.append(f'sudo -u {DEPLOYUSER} php {runner}/srv/mediawiki/{version}/maintenance/rebuildLocalisationCache.php {lang} --quiet --wiki={envinfo["wikidbname"]}')
+                stepinputs[rebuild[-1]] = stepinputs['l10n']
+
+        # stage runs in order (setup env, git pull etc), then each later phase waits for the one before it
+        deps: list[str] = []
+        for cmd in stage:
+            if 'composer' in cmd:
+                deps = [add_command_step(plan, 'stage', cmd, deps, cwd=_get_staging_path(version), inputs=None if args.ignore_fingerprints else get_composer_inputs(_get_staging_path(version)))]
+            else:
+                deps = [add_command_step(plan, 'stage', cmd, deps)]
+        if release and rsync:  # staged content goes into a new release, live switches to it in one step
+            deps = [add_command_step(plan, 'release', _construct_release_command(_construct_release_prepare(releaseroot, release)), deps)]
+        deps = [add_command_step(plan, 'rsync', cmd, deps) for cmd in rsync] or deps  # move staged content to live
+        if release and rsync:
+            deps = [add_command_step(plan, 'release', _construct_release_command(_construct_release_activate(releaseroot, release, args.keep_releases)), deps)]
+        if args.ignore_fingerprints:
+            stepinputs = {}
+        deps = [add_command_step(plan, 'postinstall', cmd, deps, inputs=stepinputs.get(cmd)) for cmd in postinstall] or deps  # cmds to run after rsync & install (like mergemessage)
+        rebuilt = [add_command_step(plan, 'rebuild', cmd, deps, inputs=stepinputs.get(cmd)) for cmd in rebuild]  # update ext list + l10n
+        if args.l10n and version and args.l10n_shards > 1:  # every shard has to succeed before l10n is synced
+            description = f'up to {args.l10n_shards} l10n shards at once: sudo -u {DEPLOYUSER} php {runner}/srv/mediawiki/{version}/maintenance/rebuildLocalisationCache.php --lang=<shard> --quiet --wiki={envinfo["wikidbname"]}'
+            action = partial(rebuild_l10n_sharded, version, args.l10n_shards, args.lang, runner, envinfo['wikidbname'])
+            if 'l10n' in stepinputs:
+                action = partial(run_fingerprinted, description, action, stepinputs['l10n'])
+            rebuilt.append(add_step(plan, 'rebuild', description, action, deps))
+        deps = rebuilt or deps
 
         # see if we are online - exit code 3 if not
-        if args.port:
-            check_up(Debug=None, Host=envinfo['wikiurl'], verify=False, force=args.force, nolog=args.nolog, port=args.port)
-        else:
-            check_up(Debug=None, Host=envinfo['wikiurl'], verify=False, force=args.force, nolog=args.nolog)
+        port = int(args.port) if args.port else 443
+        add_step(plan, 'canary', f'check {envinfo["wikiurl"]}@localhost:{port}', lambda: [0 if check_up(Debug=None, Host=envinfo['wikiurl'], verify=False, force=args.force, nolog=args.nolog, port=port) or args.force else 3], deps)
 
     # actually set remote lists
     for option in options:
@@ -597,10 +1899,49 @@ def run_process(args: argparse.Namespace, version: str = '') -> list[int]:  # pr
     if args.l10n and version:
         rsyncpaths.append(f'/srv/mediawiki/cache/{version}/l10n/')
 
+    rollout: RolloutConfig = {'wave_size': args.wave_size, 'canaries': args.canaries, 'max_error_rate': args.max_error_rate, 'max_latency': args.max_latency}
+    progress: ProgressConfig | None = {'straggler_ratio': args.straggler_ratio, 'defer': args.defer_stragglers} if args.progress else None
+    controller: SyncController | None = {'workers': 1, 'max_workers': max(args.parallel, 1), 'bwlimit': args.max_bwlimit, 'min_bwlimit': args.min_bwlimit, 'max_bwlimit': args.max_bwlimit, 'latency_target': args.latency_target, 'throughput': 0.0} if args.adaptive else None
+
+    def sync(path: str, recursive: bool, release: ReleaseConfig | None = None) -> list[int]:
+        with _remote_sync_lock:
+            results = remote_sync_file(time=args.ignore_time, serverlist=args.servers, path=path, recursive=recursive, force=args.force, envinfo=envinfo, nolog=args.nolog, parallel=args.parallel, files_from=rsyncfilelists.get(path), skip_unchanged=args.skip_unchanged, archive_threshold=args.archive_threshold if path.startswith('/srv/mediawiki/cache/') else 0, rollout=rollout, release=release, relay_fanout=args.relay_fanout, progress=progress, controller=controller)
+        syncresults.extend(results)
+        return [result['ec'] for result in results]
+
+    # remote paths go out one after another, each fanning out to the servers itself
+    deps = list(plan)[-1:]
+    releasepaths = [path for path in rsyncpaths if release and path.startswith(f'{releaseroot}/')]
     for path in rsyncpaths:
-        exitcodes.append(remote_sync_file(time=args.ignore_time, serverlist=args.servers, path=path, force=args.force, envinfo=envinfo, nolog=args.nolog))
+        if path not in releasepaths:
+            deps = [add_step(plan, 'remote', f'sync {path}', partial(sync, path, True), deps)]
+        elif release and path == releasepaths[0]:  # every path in the version tree goes out as one release
+            releaseconfig: ReleaseConfig = {'release': release, 'keep': args.keep_releases, 'paths': releasepaths, 'files_from': {path: rsyncfilelists[path] for path in releasepaths if path in rsyncfilelists}}
+            deps = [add_step(plan, 'remote', '\n  '.join([f'release {release} of {releaseroot}:', *releasepaths]), partial(sync, f'{releaseroot}/', True, releaseconfig), deps)]
     for file in rsyncfiles:
-        exitcodes.append(remote_sync_file(time=args.ignore_time, serverlist=args.servers, path=file, recursive=False, force=args.force, envinfo=envinfo, nolog=args.nolog))
+        deps = [add_step(plan, 'remote', f'sync {file}', partial(sync, file, False), deps)]
+
+    if args.dry_run:
+        print_plan(plan)
+        return exitcodes
+
+    non_zero_code(exitcodes, nolog=args.nolog)  # failed pulls
+    heads = get_staging_heads(headpaths)
+    journal: DeployJournal = load_journal(journalfile, heads) if args.resume else {'heads': heads, 'upgraded': [], 'completed': {}}
+    journal['upgraded'] = sorted(set(upgraded))
+    _save_cache_file(journalfile, dict(journal))
+    with trace_span('execute plan', version=version):
+        planresults = execute_plan(plan, jobs=args.step_jobs, completed=journal['completed'], record=partial(record_journal_step, journalfile, journal, plan))
+    if len(journal['completed']) == len(plan):
+        with suppress(OSError):
+            os.remove(journalfile)
+    else:
+        print('Deploy incomplete, run again with --resume to continue from the first unfinished step.')
+    non_zero_code([ec for name, codes in planresults.items() if plan[name]['phase'] != 'remote' for ec in codes], nolog=args.nolog)
+    exitcodes += [ec for codes in planresults.values() for ec in codes]
+
+    if syncresults:
+        print_sync_summary(syncresults)
 
     if tagsinfo:
         print('TAGS:')
@@ -617,8 +1958,8 @@ def run_process(args: argparse.Namespace, version: str = '') -> list[int]:  # pr
 
 class UpgradeExtensionsAction(argparse.Action):  # pragma: no cover
     def __call__(self, parser, namespace, values, option_string=None):  # noqa: U100
-        versions = getattr(namespace, 'versions', None)
-        if not versions:
+        versions = _get_namespace_versions(namespace)
+        if not all(versions):
             parser.error('--versions is required when using --upgrade-extensions (--versions must come before --upgrade-extensions)')
         input_extensions = values.split(',')
         valid_extensions = get_valid_extensions(versions)
@@ -632,8 +1973,8 @@ class UpgradeExtensionsAction(argparse.Action):  # pragma: no cover
 
 class UpgradeSkinsAction(argparse.Action):  # pragma: no cover
     def __call__(self, parser, namespace, values, option_string=None):  # noqa: U100
-        versions = getattr(namespace, 'versions', None)
-        if not versions:
+        versions = _get_namespace_versions(namespace)
+        if not all(versions):
             parser.error('--versions is required when using --upgrade-skins (--versions must come before --upgrade-skins)')
         input_skins = values.split(',')
         valid_skins = get_valid_skins(versions)
@@ -670,7 +2011,7 @@ class LangAction(argparse.Action):
 class VersionsAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):  # noqa: U100
         input_versions = values.split(',')
-        valid_versions = [version for version in versions.values() if os.path.exists(f'/srv/mediawiki-staging/{version}')]
+        valid_versions = [version for version in get_versions().values() if os.path.exists(f'/srv/mediawiki-staging/{version}')]
         if 'all' in input_versions:
             input_versions = valid_versions
         invalid_versions = set(input_versions) - set(valid_versions)
@@ -711,7 +2052,8 @@ if __name__ == '__main__':
     parser.add_argument('--files', dest='files')
     parser.add_argument('--folders', dest='folders')
     parser.add_argument('--lang', dest='lang', action=LangAction, help='l10n language(s) to rebuild, defaults to all')
-    parser.add_argument('--versions', dest='versions', action=VersionsAction, default=[os.popen(f'/usr/local/bin/getMWVersion {get_environment_info()["wikidbname"]}').read().strip()], help='version(s) to deploy')
+    parser.add_argument('--l10n-shards', dest='l10n_shards', type=int, default=1, help='split the l10n rebuild into this many parallel language groups')
+    parser.add_argument('--versions', dest='versions', action=VersionsAction, help='version(s) to deploy, defaults to the version of the environment wiki')
     parser.add_argument('--show-tags', dest='show_tags', action='store_true', help='Show change tags for extension/skin upgrades')
     parser.add_argument('--skip-schema-confirm', dest='skip_schema_confirm', action='store_true', help='Skip confirm prompts for extensions with schema changes')
     parser.add_argument('--upgrade-extensions', dest='upgrade_extensions', action=UpgradeExtensionsAction, help='extension(s) to upgrade')
@@ -720,5 +2062,41 @@ if __name__ == '__main__':
     parser.add_argument('--servers', dest='servers', action=ServersAction, required=True, help='server(s) to deploy to')
     parser.add_argument('--ignore-time', dest='ignore_time', action='store_true')
     parser.add_argument('--port', dest='port')
-
-    run(parser.parse_args(), start)
+    parser.add_argument('--trace', dest='trace', help='write a Chrome trace (Perfetto JSON) of the deploy to this file')
+    parser.add_argument('--probe', dest='probe', action='store_true', help='probe every server after the deploy and show a status/latency table')
+    parser.add_argument('--skip-unchanged', dest='skip_unchanged', action='store_true', help='skip servers whose last pushed manifest of a path matches the local tree')
+    parser.add_argument('--wave-size', dest='wave_size', type=int, default=0, help='roll out in parallel waves of this many servers after the canary server(s), halting if a health gate fails')
+    parser.add_argument('--canaries', dest='canaries', type=int, default=1, help='number of servers deployed to before the first wave')
+    parser.add_argument('--max-error-rate', dest='max_error_rate', type=float, default=0.0, help='fraction of deployed servers allowed to fail the health gate')
+    parser.add_argument('--max-latency', dest='max_latency', type=float, default=5.0, help='slowest canary response (seconds) allowed by the health gate')
+    parser.add_argument('--ignore-fingerprints', dest='ignore_fingerprints', action='store_true', help='run composer and rebuild steps even if their inputs are unchanged since their last successful run')
+    parser.add_argument('--releases', dest='releases', action='store_true', help='deploy version trees into a new hardlinked release directory and switch to it atomically')
+    parser.add_argument('--keep-releases', dest='keep_releases', type=int, default=5, help='number of release directories kept per version tree')
+    parser.add_argument('--rollback', dest='rollback', action='store_true', help='switch the version trees back to their previous release on every server')
+    parser.add_argument('--progress', dest='progress', action='store_true', help='show live rsync progress per server and flag stragglers')
+    parser.add_argument('--straggler-ratio', dest='straggler_ratio', type=float, default=0.5, help='flag servers syncing slower than this fraction of the median rate, 0 to disable')
+    parser.add_argument('--defer-stragglers', dest='defer_stragglers', action='store_true', help='with --progress, stop stragglers and retry them after the other servers')
+    parser.add_argument('--adaptive', dest='adaptive', action='store_true', help='adjust the servers synced at once (up to --parallel) and the bandwidth limit to the throughput and canary latency measured')
+    parser.add_argument('--latency-target', dest='latency_target', type=float, default=1.0, help='with --adaptive, back off while canary requests take longer than this many seconds')
+    parser.add_argument('--min-bwlimit', dest='min_bwlimit', type=int, default=1024, help='with --adaptive, never limit a transfer below this many KiB/s')
+    parser.add_argument('--max-bwlimit', dest='max_bwlimit', type=int, default=0, help='with --adaptive, never let a transfer exceed this many KiB/s, 0 for no limit')
+    parser.add_argument('--relay-fanout', dest='relay_fanout', type=int, default=0, help=f'let every updated server push each path on to this many more servers, with {RELAY_KEY} forwarded from a private ssh agent')
+    parser.add_argument('--resume', dest='resume', action='store_true', help='skip the steps an interrupted deploy with the same options already completed, if staging has not changed since')
+    parser.add_argument('--no-reuse-ssh', dest='reuse_ssh', action='store_false', help='open a new ssh connection for every sync instead of one multiplexed connection per server')
+    parser.add_argument('--archive-threshold', dest='archive_threshold', type=int, default=0, help='stream cache directories with at least this many files as a tar archive instead of rsync, 0 to disable')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='only sync the files changed by extension/skin upgrades')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='number of extension/skin repositories to pull at once')
+    parser.add_argument('--step-jobs', dest='step_jobs', type=int, default=1, help='number of independent deploy steps to run at once')
+    parser.add_argument('--parallel-versions', dest='parallel_versions', action='store_true', help='run the pipelines for each version at the same time')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='print the deploy plan instead of running it')
+    parser.add_argument('--parallel', dest='parallel', type=int, default=1, help='number of servers to sync to at once')
+
+    args = parser.parse_args()
+    _get_namespace_versions(args)
+    if args.parallel_versions and (args.upgrade_extensions or args.upgrade_skins or args.upgrade_world) and not args.skip_schema_confirm:
+        parser.error('--parallel-versions can not prompt for schema changes, use --skip-schema-confirm with extension/skin upgrades')
+    if args.relay_fanout and (args.wave_size or args.releases):
+        parser.error('--relay-fanout can not be combined with --wave-size or --releases')
+    if args.adaptive and (args.wave_size or args.relay_fanout):
+        parser.error('--adaptive can not be combined with --wave-size or --relay-fanout')
+    run(args, start)
@@ -0,0 +1,70 @@
+"""Compare classify_change with the get_change_tag_map regexes it replaced.
+
+The regexes are kept here as the reference definition of each change tag.
+
+Run with: python -m tests.benchmark_change_tags [count]
+"""
+from functools import cache
+import random
+import re
+import sys
+import time
+
+from miraheze.mediawiki import mwdeploy
+
+DIRECTORIES = ['', 'i18n/', 'i18n/api/', 'tests/', 'tests/phpunit/', 'includes/', 'resources/src/', 'sql/', 'sql/mysql/', '.github/workflows/', 'modules/i18n/', 'lib/tests/i18n/']
+FILES = ['en.json', 'qqq.json', 'Hooks.php', 'init.js', 'styles.less', 'main.css', 'App.vue', 'types.d.ts', 'module.lua', 'tpl.mustache', 'tables.sql', 'patch-add-index.sql', 'extension.json', 'skin.json', 'composer.json', 'package-lock.json', 'Gruntfile.js', '.eslintrc.json', 'README.md', 'COPYING', 'logo.svg']
+
+
+def generate_paths(count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    return [f'{rng.choice(DIRECTORIES)}{rng.choice(DIRECTORIES)}{rng.choice(FILES)}' for _ in range(count)]
+
+
+@cache
+def get_change_tag_map() -> dict[re.Pattern, str]:
+    build_regex = re.compile(r'^.*?(\.github/.*?|\.phan/.*?|tests/.*?|composer(\.json|\.lock)|package(-lock)?\.json|yarn\.lock|(\.phpcs|\.stylelintrc|\.eslintrc|\.prettierrc|\.stylelintignore|\.eslintignore|\.prettierignore|tsconfig)\.json|\.nvmrc|\.svgo\.config\.js|Gruntfile\.js|bundlesize\.config\.json|jsdoc\.json)$')
+    codechange_regex = re.compile(
+        rf'(?!.*{build_regex.pattern})'
+        r'^.*?(\.(php|js|css|less|scss|vue|lua|mustache|d\.ts)|extension(-repo|-client)?\.json|skin\.json)$',
+    )
+    schema_regex = re.compile(
+        rf'(?!.*{build_regex.pattern})'
+        r'^.*?\.sql$',
+    )
+    i18n_regex = re.compile(r'^.*?i18n/.*?\.json$')
+    return {
+        codechange_regex: 'code change',
+        schema_regex: 'schema change',
+        build_regex: 'build',
+        i18n_regex: 'i18n',
+    }
+
+
+def legacy_tags(file: str) -> set[str]:
+    return {tag for regex, tag in get_change_tag_map().items() if regex.match(file)}
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    paths = generate_paths(count)
+
+    start = time.perf_counter()
+    legacy = [legacy_tags(path) for path in paths]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = [mwdeploy.classify_change(path) for path in paths]
+    current_time = time.perf_counter() - start
+
+    mismatches = [path for path, old, new in zip(paths, legacy, current) if old != new]
+    print(f'{count} paths: regex map {legacy_time:.3f}s, classify_change {current_time:.3f}s ({legacy_time / current_time:.1f}x)')
+    print(f'Identical results: {not mismatches}')
+    for path in mismatches[:10]:
+        print(f'MISMATCH: {path}')
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Fake fleet for tests/benchmark_mwdeploy.py.
+
+Stand-ins for ssh, rsync, php and composer on the deploy host, and a siteinfo API answering for every
+server. Servers are directories under <root>/hosts/. The commands only import the standard library
+so their startup does not skew the timings.
+"""
+import fnmatch
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+ROOT_ENV = 'MWDEPLOY_BENCH_ROOT'
+HOST_ENV = 'MWDEPLOY_BENCH_HOST'
+COMMANDS = ('ssh', 'rsync', 'php', 'composer')
+
+
+def delay(name: str) -> None:
+    time.sleep(float(os.environ.get(f'MWDEPLOY_BENCH_{name.upper()}_DELAY', 0)))
+
+
+def get_host_root(host: str | None) -> str:
+    root = os.environ[ROOT_ENV]
+    return f'{root}/hosts/{host}' if host else root
+
+
+def host_path(path: str, host: str) -> str:
+    # commands ssh runs on a host see its tree, so relays map from there onwards
+    return path.replace(f'{get_host_root(os.environ.get(HOST_ENV))}/srv/', f'{get_host_root(host)}/srv/')
+
+
+def get_host(destination: str) -> str:
+    return destination.split('@')[-1].split('.')[0]
+
+
+def get_control_marker(control_path: str | None, host: str) -> str | None:
+    return control_path.replace('%C', host) if control_path and control_path != 'none' else None
+
+
+def connect(host: str, control_path: str | None) -> bool:
+    # a multiplexed connection skips the handshake
+    marker = get_control_marker(control_path, host)
+    if marker and os.path.exists(marker):
+        return True
+    delay('ssh')
+    return False
+
+
+def ssh(args: list[str]) -> int:
+    control_path = None
+    positional: list[str] = []
+    master = forward_agent = False
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if positional:
+            positional.append(arg)
+        elif arg in ('-i', '-o', '-p', '-l', '-O', '-S', '-F'):
+            index += 1
+            if arg == '-O':  # control command, ssh -O exit
+                marker = get_control_marker(control_path, get_host(args[-1]))
+                if marker and os.path.exists(marker):
+                    os.remove(marker)
+                return 0
+            if args[index].startswith('ControlPath='):
+                control_path = args[index].split('=', 1)[1]
+            elif arg == '-S':
+                control_path = args[index]
+        elif arg.startswith('-'):
+            master = master or 'N' in arg
+            forward_agent = forward_agent or 'A' in arg
+        else:
+            positional.append(arg)
+        index += 1
+    host = get_host(positional[0])
+    multiplexed = connect(host, control_path)
+    marker = get_control_marker(control_path, host)
+    if master:
+        if marker:
+            # like OpenSSH, the master alone decides whether its sessions get an agent
+            with open(marker, 'w') as master_file:
+                master_file.write(os.environ.get('SSH_AUTH_SOCK', '') if forward_agent else '')
+        return 0
+    if len(positional) == 1:
+        return 0
+    env = {**os.environ, HOST_ENV: host}
+    if multiplexed and marker:
+        with open(marker) as master_file:
+            env['SSH_AUTH_SOCK'] = master_file.read()
+    elif not forward_agent:
+        env.pop('SSH_AUTH_SOCK', None)
+    return subprocess.run(host_path(' '.join(positional[1:]), host), shell=True, env=env).returncode
+
+
+def is_excluded(name: str, excludes: list[str]) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in excludes)
+
+
+def remove(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def copy_file(source: str, target: str, update: bool) -> None:
+    if os.path.isdir(target) and not os.path.islink(target):
+        shutil.rmtree(target)
+    elif os.path.lexists(target):
+        source_stat, target_stat = os.lstat(source), os.lstat(target)
+        if update and target_stat.st_mtime > source_stat.st_mtime:
+            return
+        # rsync's quick check
+        if source_stat.st_size == target_stat.st_size and int(source_stat.st_mtime) == int(target_stat.st_mtime):
+            return
+        os.remove(target)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+    else:
+        shutil.copy2(source, target)
+
+
+def copy_tree(source: str, target: str, update: bool, delete: bool, excludes: list[str]) -> None:
+    if os.path.lexists(target) and (os.path.islink(target) or not os.path.isdir(target)):
+        os.remove(target)
+    os.makedirs(target, exist_ok=True)
+    names = {name for name in os.listdir(source) if not is_excluded(name, excludes)}
+    for name in sorted(names):
+        copy_entry(os.path.join(source, name), os.path.join(target, name), update, delete, excludes)
+    if delete:
+        for name in os.listdir(target):
+            if name not in names and not is_excluded(name, excludes):
+                remove(os.path.join(target, name))
+
+
+def copy_entry(source: str, target: str, update: bool, delete: bool, excludes: list[str], recursive: bool = True) -> None:
+    if os.path.isdir(source) and not os.path.islink(source):
+        if recursive:
+            copy_tree(source, target, update, delete, excludes)
+        else:
+            print(f'skipping directory {source}')
+    else:
+        copy_file(source, target, update)
+
+
+def rsync(args: list[str]) -> int:
+    recursive = delete = update = delete_missing = False
+    excludes: list[str] = []
+    files_from = None
+    shell = ''
+    paths = []
+    arguments = iter(args)
+    for arg in arguments:
+        if arg == '-e':
+            shell = next(arguments)
+        elif arg.startswith('--exclude='):
+            excludes.append(arg.split('=', 1)[1])
+        elif arg.startswith('--files-from='):
+            files_from = arg.split('=', 1)[1]
+        elif arg in ('--delete', '--update', '--delete-missing-args'):
+            delete = delete or arg == '--delete'
+            update = update or arg == '--update'
+            delete_missing = delete_missing or arg == '--delete-missing-args'
+        elif arg.startswith('-') and not arg.startswith('--'):
+            recursive = recursive or 'r' in arg
+        elif not arg.startswith('-'):
+            paths.append(arg)
+    *sources, target = paths
+    if ':' in target:
+        destination, target = target.split(':', 1)
+        host = get_host(destination)
+        # servers hold no key of their own, a relay needs the agent forwarded to it
+        if os.environ.get(HOST_ENV) and not os.path.exists(os.environ.get('SSH_AUTH_SOCK', '')):
+            print(f'{destination}: Permission denied (publickey).', file=sys.stderr)
+            return 255
+        control_path = next((option.split('=', 1)[1] for option in shell.split() if option.startswith('ControlPath=')), None)
+        connect(host, control_path)
+        target = host_path(target, host)
+    try:
+        if files_from:
+            with open(files_from) as file_list:
+                names = [line.strip() for line in file_list if line.strip()]
+            for name in names:
+                if os.path.lexists(os.path.join(sources[0], name)):
+                    copy_entry(os.path.join(sources[0], name), os.path.join(target, name), update, False, excludes, recursive=False)
+                elif delete_missing:
+                    remove(os.path.join(target, name))
+            return 0
+        for source in sources:
+            if source.endswith('/') and os.path.isdir(source):
+                copy_tree(source, target, update, delete, excludes)
+            elif target.endswith('/') or os.path.isdir(target):
+                copy_entry(source, os.path.join(target, os.path.basename(source)), update, delete, excludes, recursive)
+            else:
+                copy_entry(source, target, update, delete, excludes, recursive)
+    except OSError as e:
+        print(f'rsync error: {e}', file=sys.stderr)
+        return 23
+    return 0
+
+
+def write_file(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(content)
+
+
+def php(args: list[str]) -> int:
+    script, *options = [arg for arg in args if not arg.endswith('/maintenance/run.php')]
+    name = os.path.basename(script).removesuffix('.php')
+    values = dict(option[2:].split('=', 1) for option in options if option.startswith('--') and '=' in option)
+    root = os.environ[ROOT_ENV]
+    delay('php')
+    if name == 'mergeMessageFileList':
+        write_file(options[options.index('--output') + 1], f'<?php\n// {values["extensions-dir"]}\n')
+    elif name == 'ManageWiki:RebuildExtensionListCache':
+        write_file(os.path.join(values['cachedir'], 'extension-list.json'), '{}')
+    elif name == 'rebuildVersionCache':
+        write_file(f'{root}/srv/mediawiki/cache/{values["version"]}/gitinfo/info.json', json.dumps({'version': values['version']}))
+    elif name == 'rebuildLocalisationCache':
+        version_path = os.path.dirname(os.path.dirname(script))
+        if values.get('lang'):
+            languages = values['lang'].split(',')
+        else:
+            languages = [file.removesuffix('.json') for file in os.listdir(f'{version_path}/languages/i18n') if file.endswith('.json') and file != 'qqq.json']
+        size = int(os.environ.get('MWDEPLOY_BENCH_L10N_KB', 32)) * 1024
+        for language in languages:
+            delay('l10n')
+            write_file(f'{root}/srv/mediawiki/cache/{os.path.basename(version_path)}/l10n/l10n_cache-{language}.cdb', (language * size)[:size])
+    return 0
+
+
+def composer(args: list[str]) -> int:  # noqa: U100
+    delay('composer')
+    return 0
+
+
+def main(name: str, args: list[str]) -> int:
+    return {'ssh': ssh, 'rsync': rsync, 'php': php, 'composer': composer}[name](args)
+
+
+def install_commands(path: str, names: tuple[str, ...] = COMMANDS) -> None:
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(path, exist_ok=True)
+    for name in names:
+        command = os.path.join(path, name)
+        with open(command, 'w') as script:
+            script.write(f'#!{sys.executable}\nimport sys\nsys.path.insert(0, {repo!r})\nfrom tests.benchmark_fleet import main\nsys.exit(main({name!r}, sys.argv[1:]))\n')
+        os.chmod(command, 0o755)
+
+
+class SiteinfoHandler(http.server.BaseHTTPRequestHandler):
+    server: 'SiteinfoServer'
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.latency)
+        body = json.dumps({'batchcomplete': True, 'query': {'general': {'sitename': 'Miraheze Meta', 'server': 'https://meta.miraheze.org'}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        # the debug header picks the server answering, like the real load balancer
+        self.send_header('X-Served-By', self.headers.get('X-WikiTide-Debug', 'deploy'))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002,U100
+        pass
+
+
+class SiteinfoServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    latency = 0.0
+
+
+def start_siteinfo_api(latency: float = 0.0) -> SiteinfoServer:
+    server = SiteinfoServer(('127.0.0.1', 0), SiteinfoHandler)
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
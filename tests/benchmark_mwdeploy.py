@@ -0,0 +1,388 @@
+"""Time end-to-end mwdeploy.run_process scenarios on a synthetic staging tree and a fake fleet.
+
+Everything happens under a temporary root: mwdeploy's view of /srv is redirected into it, every
+server is a directory under hosts/, and ssh, rsync, php and composer are the stand-ins from
+tests/benchmark_fleet.py (a real rsync is used when installed). Each scenario starts from a fresh
+copy of the generated tree, so results are comparable between runs and commits.
+
+Run with: python -m tests.benchmark_mwdeploy [--extensions N] [--servers N] [--repeat N] [--json FILE] [--compare FILE] [scenario ...]
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Iterator
+from unittest.mock import patch
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from miraheze.mediawiki import mwdeploy
+from tests import benchmark_fleet
+
+VERSION = '1.45'
+DEPLOY_HOST = 'deploy'
+
+# run_process options as parsed from a command line without any flags
+DEFAULTS = {
+    'config': False, 'world': False, 'landing': False, 'errorpages': False, 'reset_world': False, 'pull': None, 'branch': None,
+    'upgrade_vendor': False, 'upgrade_extensions': None, 'upgrade_skins': None, 'force': False, 'force_upgrade': False,
+    'skip_schema_confirm': True, 'show_tags': False, 'incremental': False, 'files': None, 'folders': None, 'extension_list': False,
+    'l10n': False, 'lang': None, 'ignore_time': False, 'port': None, 'parallel': 1, 'jobs': 1, 'step_jobs': 1, 'skip_unchanged': False, 'nolog': True,
+    'dry_run': False, 'trace': None, 'probe': False, 'parallel_versions': False, 'l10n_shards': 1, 'archive_threshold': 0,
+    'reuse_ssh': False, 'wave_size': 0, 'canaries': 1, 'max_error_rate': 0.0, 'max_latency': 5.0, 'resume': False,
+    'ignore_fingerprints': False, 'releases': False, 'keep_releases': 5, 'rollback': False, 'relay_fanout': 0, 'progress': False, 'straggler_ratio': 0.5, 'defer_stragglers': False, 'adaptive': False, 'latency_target': 1.0, 'min_bwlimit': 1024, 'max_bwlimit': 0,
+}
+
+# options: run_process options on top of DEFAULTS ('all' upgrades every generated extension)
+# version: deploy a MediaWiki version rather than config, warm: deploy once untimed first
+# changed: fraction of extensions with new upstream commits, ssh: multiplex ssh connections
+SCENARIOS: dict[str, dict] = {
+    'config': {'options': {'config': True}},
+    'config-parallel': {'options': {'config': True, 'parallel': 0}},
+    'config-unchanged': {'options': {'config': True, 'skip_unchanged': True}, 'warm': True},
+    'config-ssh-reuse': {'options': {'config': True}, 'ssh': True},
+    'config-adaptive': {'options': {'config': True, 'parallel': 0, 'adaptive': True}},
+    'upgrade-extensions': {'options': {'upgrade_extensions': 'all'}, 'version': True, 'changed': 0.1},
+    'upgrade-extensions-parallel': {'options': {'upgrade_extensions': 'all', 'jobs': 8, 'step_jobs': 8, 'parallel': 0, 'incremental': True}, 'version': True, 'changed': 0.1},
+    'upgrade-extensions-releases': {'options': {'upgrade_extensions': 'all', 'jobs': 8, 'step_jobs': 8, 'parallel': 0, 'incremental': True, 'releases': True}, 'version': True, 'changed': 0.1},
+    'l10n': {'options': {'l10n': True}, 'version': True},
+    'l10n-sharded': {'options': {'l10n': True, 'l10n_shards': 4}, 'version': True},
+    'l10n-unchanged': {'options': {'l10n': True}, 'version': True, 'warm': True},
+    'world': {'options': {'world': True, 'extension_list': True, 'parallel': 0}, 'version': True},
+    'world-archive': {'options': {'world': True, 'extension_list': True, 'parallel': 0, 'archive_threshold': 100}, 'version': True},
+    'world-relay': {'options': {'world': True, 'extension_list': True, 'relay_fanout': 2}, 'version': True, 'ssh': True},
+}
+
+
+def git(*args: str, cwd: str) -> None:
+    subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def write_files(path: str, files: dict[str, str]) -> None:
+    for name, content in files.items():
+        benchmark_fleet.write_file(os.path.join(path, name), content)
+
+
+def create_repo(upstream: str, clone: str, files: dict[str, str]) -> None:
+    write_files(upstream, files)
+    git('init', '-q', cwd=upstream)
+    git('add', '-A', cwd=upstream)
+    git('commit', '-q', '-m', 'Initial commit', cwd=upstream)
+    git('clone', '-q', upstream, clone, cwd=upstream)
+
+
+def get_languages(count: int) -> list[str]:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    codes = [f'{first}{second}' for first in letters for second in letters if f'{first}{second}' != 'en']
+    return ['en', 'qqq', *codes[:max(count - 1, 0)]]
+
+
+def get_messages(rng: random.Random, prefix: str, count: int) -> str:
+    return json.dumps({f'{prefix}-message-{index}': ' '.join(rng.choices(['wiki', 'page', 'user', 'edit', 'save', 'the', 'a'], k=8)) for index in range(count)}, indent='\t')
+
+
+def generate_tree(root: str, params: argparse.Namespace) -> list[str]:
+    rng = random.Random(1)
+    staging = f'{root}/srv/mediawiki-staging'
+    upstream = f'{root}/upstream'
+    core = f'{staging}/{VERSION}'
+    languages = get_languages(params.languages)
+
+    files = {'.gitignore': 'extensions/\nskins/\nvendor/\n', 'composer.json': '{"require": {}}', 'composer.local.json': '{"extra": {"merge-plugin": {"include": ["extensions/*/composer.json", "skins/*/composer.json"]}}}', 'maintenance/run.php': '<?php\n'}
+    files.update({f'languages/i18n/{language}.json': get_messages(rng, 'core', 200) for language in languages})
+    files.update({f'languages/messages/Messages{language.capitalize()}.php': '<?php\n$fallback = "en";\n' for language in languages})
+    files.update({f'includes/Class{index}.php': f'<?php\nclass Class{index} {{}}\n' for index in range(params.core_files)})
+    create_repo(f'{upstream}/core', core, files)
+    create_repo(f'{upstream}/vendor', f'{core}/vendor', {f'package{index}/src/Lib.php': '<?php\n' for index in range(100)} | {'composer/installed.json': '{}'})
+    create_repo(f'{upstream}/config', f'{staging}/config', {f'Config{index}.php': f'<?php\n$wgSetting{index} = true;\n' for index in range(params.config_files)} | {'LocalSettings.php': '<?php\n'})
+
+    extensions = [f'Extension{index:03d}' for index in range(params.extensions)]
+    for kind, names, manifest in (('extensions', extensions, 'extension.json'), ('skins', [f'Skin{index:02d}' for index in range(params.skins)], 'skin.json')):
+        for name in names:
+            files = {manifest: json.dumps({'name': name, 'MessagesDirs': {name: ['i18n']}}), 'includes/Hooks.php': '<?php\n'}
+            files.update({f'includes/Class{index}.php': f'<?php\nclass {name}{index} {{}}\n' for index in range(rng.randint(5, 40))})
+            files.update({f'i18n/{language}.json': get_messages(rng, name.lower(), 20) for language in rng.sample(languages, min(len(languages), rng.randint(5, 60)))})
+            if rng.random() < 0.3:
+                files['composer.json'] = '{"require": {}}'
+            create_repo(f'{upstream}/{kind}/{name}', f'{core}/{kind}/{name}', files)
+    benchmark_fleet.write_file(f'{staging}/deploykey', '')
+
+    # what the previous deploy left on the deploy host and the servers
+    live = f'{root}/srv/mediawiki'
+    for repo in (VERSION, 'config'):
+        shutil.copytree(f'{staging}/{repo}', f'{live}/{repo}', symlinks=True, ignore=shutil.ignore_patterns('.*'))
+    size = params.l10n_kb * 1024
+    write_files(f'{live}/cache/{VERSION}/l10n', {f'l10n_cache-{language}.cdb': (language * size)[:size] for language in languages if language != 'qqq'})
+    write_files(f'{live}/cache/{VERSION}', {'gitinfo/info.json': '{}', 'extension-list.json': '{}'})
+    benchmark_fleet.write_file(f'{live}/config/ExtensionMessageFiles-{VERSION}.php', '<?php\n')
+    for server in get_fleet(params.servers):
+        shutil.copytree(live, f'{root}/hosts/{server}/srv/mediawiki', symlinks=True)
+    return extensions
+
+
+def get_fleet(servers: int) -> list[str]:
+    return [f'mw{151 + index // 2 * 10 + index % 2}' for index in range(servers)]
+
+
+def copy_tree(template: str, work: str) -> None:
+    shutil.copytree(template, work, symlinks=True)
+    # clones point at the template's upstream repositories
+    for config in glob.glob(f'{work}/srv/mediawiki-staging/**/.git/config', recursive=True):
+        with open(config) as file:
+            content = file.read()
+        with open(config, 'w') as file:
+            file.write(content.replace(template, work))
+
+
+def change_upstream(work: str, extensions: list[str], count: int) -> None:
+    for name in extensions[:count]:
+        path = f'{work}/upstream/extensions/{name}'
+        messages = {}
+        if os.path.exists(f'{path}/i18n/en.json'):  # not every extension has English messages
+            with open(f'{path}/i18n/en.json') as file:
+                messages = json.load(file)
+        messages[f'{name.lower()}-new-message'] = 'A new message'
+        write_files(path, {'i18n/en.json': json.dumps(messages, indent='\t'), 'includes/NewFeature.php': '<?php\nclass NewFeature {}\n'})
+        git('add', '-A', cwd=path)
+        git('commit', '-q', '-m', 'New feature', cwd=path)
+
+
+def reroot_path(root: str, path: object) -> object:
+    if isinstance(path, str) and re.match(r'/srv(/|$)', path):
+        return f'{root}{path}'
+    return path
+
+
+def reroot_command(root: str, command: object) -> object:
+    if not isinstance(command, str):
+        return command
+    command = command.replace(f'sudo -u {mwdeploy.DEPLOYUSER} ', '')
+    return re.sub(r'(?<![\w./-])/srv/', f'{root}/srv/', command)
+
+
+class Rerooted:
+    """A module whose functions see /srv under the benchmark root."""
+
+    def __init__(self, module: object, root: str, paths: tuple[str, ...] = (), commands: tuple[str, ...] = (), children: dict[str, 'Rerooted'] | None = None):
+        self.module = module
+        self.root = root
+        self.paths = paths
+        self.commands = commands
+        self.children = children or {}
+
+    def __getattr__(self, name: str) -> object:
+        if name in self.children:
+            return self.children[name]
+        value = getattr(self.module, name)
+        if name in self.paths or name in self.commands:
+            return rerooted(value, self.root, reroot_path if name in self.paths else reroot_command)
+        return value
+
+
+def rerooted(function: Callable, root: str, translate: Callable[[str, object], object] = reroot_path) -> Callable:
+    def wrapper(*args: object, **kwargs: object) -> object:
+        return function(*(translate(root, arg) for arg in args), **{key: reroot_path(root, value) for key, value in kwargs.items()})
+
+    return wrapper
+
+
+class FleetAdapter(HTTPAdapter):
+    """Sends every canary request to the fake siteinfo API."""
+
+    def __init__(self, port: int):
+        super().__init__()
+        self.port = port
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:  # type: ignore[override]
+        url = urlsplit(request.url or '')
+        request.url = urlunsplit(('http', f'127.0.0.1:{self.port}', url.path, url.query, ''))
+        return super().send(request, **kwargs)
+
+
+def get_fleet_session(port: int) -> requests.Session:
+    session = requests.Session()
+    session.mount('http://', FleetAdapter(port))
+    session.mount('https://', FleetAdapter(port))
+    return session
+
+
+@contextmanager
+def fake_fleet(root: str, bin_path: str, session: requests.Session, env: dict[str, str]) -> Iterator[None]:
+    path_functions = ('listdir', 'scandir', 'stat', 'lstat', 'walk', 'readlink', 'remove', 'makedirs')
+    rerooted_os = Rerooted(os, root, paths=path_functions, commands=('system', 'popen'), children={'path': Rerooted(os.path, root, paths=('exists', 'isdir', 'islink', 'relpath'))})
+    cache = f'{root}/cache'
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(mwdeploy, 'os', rerooted_os))
+        stack.enter_context(patch.object(mwdeploy, 'glob', Rerooted(glob, root, paths=('glob',))))
+        stack.enter_context(patch.object(mwdeploy, 'subprocess', Rerooted(subprocess, root, commands=('Popen',))))
+        stack.enter_context(patch.object(mwdeploy, 'open', rerooted(open, root), create=True))
+        stack.enter_context(patch.object(mwdeploy, 'HOSTNAME', DEPLOY_HOST))
+        stack.enter_context(patch.object(mwdeploy, 'get_canary_session', return_value=session))
+        register = stack.enter_context(patch.object(mwdeploy.atexit, 'register'))
+        stack.enter_context(patch.dict(mwdeploy.versions, {VERSION: VERSION}, clear=True))
+        for name, file in (('REPO_INDEX_FILE', 'repo-index.json'), ('VERSIONS_CACHE_FILE', 'versions.json'), ('MANIFEST_DIR', 'manifests'), ('PUSHED_MANIFEST_FILE', 'pushed-manifests.json'), ('FINGERPRINT_FILE', 'fingerprints.json'), ('JOURNAL_DIR', 'journal')):
+            stack.enter_context(patch.object(mwdeploy, name, f'{cache}/{file}'))
+        # stands in for the relay agent's socket, the fake rsync only checks that relays can reach it
+        benchmark_fleet.write_file(f'{cache}/relay-agent', '')
+        stack.enter_context(patch.object(mwdeploy, '_relay_agent_socket', f'{cache}/relay-agent'))
+        stack.enter_context(patch.dict(os.environ, {**env, 'PATH': f'{bin_path}:{os.environ["PATH"]}', benchmark_fleet.ROOT_ENV: root}))
+        try:
+            yield
+        finally:
+            # incremental file lists are otherwise only removed when the process exits
+            for call in register.call_args_list:
+                if call.args[0] is mwdeploy._remove_file_list:
+                    mwdeploy._remove_file_list(*call.args[1:])
+
+
+@contextmanager
+def output_to(path: str) -> Iterator[None]:
+    # commands write straight to fd 1, so redirect that rather than sys.stdout
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(path, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def reset_state() -> None:
+    mwdeploy.clear_change_index()
+    mwdeploy._repo_index.clear()
+    mwdeploy._ssh_control_path = None
+
+
+def deploy(args: argparse.Namespace, version: str, fleet: list[str], ssh: bool) -> list[int]:
+    reset_state()
+    if ssh:
+        mwdeploy.start_ssh_multiplexing(fleet)
+    try:
+        return mwdeploy.run_process(args=argparse.Namespace(**vars(args)), version=version)
+    finally:
+        if ssh:
+            mwdeploy.stop_ssh_multiplexing(fleet)
+            mwdeploy._ssh_control_path = None
+
+
+def run_scenario(name: str, template: str, extensions: list[str], params: argparse.Namespace, session: requests.Session, env: dict[str, str], log: str) -> float:
+    scenario = SCENARIOS[name]
+    fleet = get_fleet(params.servers)
+    work = f'{params.root}/work'
+    copy_tree(template, work)
+    change_upstream(work, extensions, int(len(extensions) * scenario.get('changed', 0)))
+    options = {**DEFAULTS, 'servers': [*fleet, DEPLOY_HOST], **scenario['options']}
+    if options['upgrade_extensions'] == 'all':
+        options['upgrade_extensions'] = extensions
+    if options['parallel'] == 0:
+        options['parallel'] = len(fleet)
+    args = argparse.Namespace(**options)
+    version = VERSION if scenario.get('version') else ''
+    try:
+        with fake_fleet(work, f'{params.root}/bin', session, env), output_to(log):
+            print(f'=== {name} ===')
+            if scenario.get('warm'):
+                deploy(args, version, fleet, scenario.get('ssh', False))
+            start = time.perf_counter()
+            exitcodes = deploy(args, version, fleet, scenario.get('ssh', False))
+            elapsed = time.perf_counter() - start
+    except SystemExit:
+        exitcodes = [1]
+    finally:
+        shutil.rmtree(work)
+    if any(exitcodes):
+        raise RuntimeError(f'{name} failed with {exitcodes}, see {log}')
+    return elapsed
+
+
+def print_results(results: dict[str, list[float]], previous: dict[str, list[float]]) -> None:
+    print(f'{"scenario":<30} {"median":>9} {"min":>9} {"max":>9} {"change":>9}')
+    for name, times in results.items():
+        median = statistics.median(times)
+        change = ''
+        if previous.get(name):
+            change = f'{(median / statistics.median(previous[name]) - 1) * 100:+.1f}%'
+        print(f'{name:<30} {median:>8.2f}s {min(times):>8.2f}s {max(times):>8.2f}s {change:>9}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark mwdeploy deploys against a synthetic staging tree and a fake fleet')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run (default: all of {", ".join(SCENARIOS)})')
+    parser.add_argument('--extensions', type=int, default=200)
+    parser.add_argument('--skins', type=int, default=10)
+    parser.add_argument('--languages', type=int, default=300)
+    parser.add_argument('--l10n-kb', dest='l10n_kb', type=int, default=32, help='size of each l10n cache file')
+    parser.add_argument('--core-files', dest='core_files', type=int, default=1000)
+    parser.add_argument('--config-files', dest='config_files', type=int, default=300)
+    parser.add_argument('--servers', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ssh-delay', dest='ssh_delay', type=float, default=0.05, help='seconds per new ssh connection')
+    parser.add_argument('--canary-latency', dest='canary_latency', type=float, default=0.01)
+    parser.add_argument('--php-delay', dest='php_delay', type=float, default=0.2, help='seconds per maintenance script')
+    parser.add_argument('--l10n-delay', dest='l10n_delay', type=float, default=0.01, help='seconds per language rebuilt')
+    parser.add_argument('--composer-delay', dest='composer_delay', type=float, default=2.0)
+    parser.add_argument('--json', dest='json_file', help='write the timings to this file')
+    parser.add_argument('--compare', help='timings written by an earlier --json run to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the generated tree and logs')
+    params = parser.parse_args()
+    names = params.scenarios or list(SCENARIOS)
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenario(s): {", ".join(sorted(unknown))}')
+
+    params.root = tempfile.mkdtemp(prefix='mwdeploy-bench-')
+    template = f'{params.root}/template'
+    log = f'{params.root}/deploy.log'
+    env = {
+        'MWDEPLOY_BENCH_SSH_DELAY': str(params.ssh_delay), 'MWDEPLOY_BENCH_PHP_DELAY': str(params.php_delay),
+        'MWDEPLOY_BENCH_L10N_DELAY': str(params.l10n_delay), 'MWDEPLOY_BENCH_COMPOSER_DELAY': str(params.composer_delay),
+        'MWDEPLOY_BENCH_L10N_KB': str(params.l10n_kb),
+        'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@localhost', 'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@localhost',
+    }
+    os.environ.update({key: value for key, value in env.items() if key.startswith('GIT_')})
+    commands = benchmark_fleet.COMMANDS if not shutil.which('rsync') else tuple(command for command in benchmark_fleet.COMMANDS if command != 'rsync')
+    benchmark_fleet.install_commands(f'{params.root}/bin', commands)
+    api = benchmark_fleet.start_siteinfo_api(params.canary_latency)
+    session = get_fleet_session(api.server_address[1])
+
+    previous = {}
+    if params.compare:
+        with open(params.compare) as file:
+            previous = json.load(file)['results']
+
+    try:
+        start = time.perf_counter()
+        extensions = generate_tree(template, params)
+        print(f'Generated {len(extensions)} extensions, {params.skins} skins, {params.languages} languages and {params.servers} servers in {time.perf_counter() - start:.1f}s')
+        results: dict[str, list[float]] = {}
+        for name in names:
+            results[name] = [run_scenario(name, template, extensions, params, session, env, log) for _ in range(params.repeat)]
+            print(f'{name}: {statistics.median(results[name]):.2f}s')
+        print_results(results, previous)
+        if params.json_file:
+            with open(params.json_file, 'w') as file:
+                json.dump({'params': {key: value for key, value in vars(params).items() if key not in ('root', 'json_file', 'compare', 'keep')}, 'results': results}, file, indent=2)
+    finally:
+        api.shutdown()
+        if params.keep:
+            print(f'Tree and logs kept in {params.root}')
+        else:
+            shutil.rmtree(params.root)
+
+
+if __name__ == '__main__':
+    main()
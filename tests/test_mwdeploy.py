@@ -1,8 +1,14 @@
 import argparse
+import io
+import itertools
+import json
 import os
-import re
+import shlex
+import subprocess
+import threading
 import pytest
 import unittest
+from functools import partial
 from unittest.mock import MagicMock, patch
 from miraheze.mediawiki import mwdeploy
 from miraheze.mediawiki.mwdeploy import (
@@ -23,24 +29,24 @@ class TestTagFunctions(unittest.TestCase):
         self.expected_schema_files = {'test.sql', 'sql/test.sql'}
         self.expected_build_files = {'tests/test1.js', 'tests/test.sql', 'composer.lock'}
         self.expected_i18n_files = {'i18n/en.json', 'i18n/fr.json', 'test/i18n/test/en.json', 'test/i18n/test/fr.json'}
+        mwdeploy.clear_change_index()
 
-    def test_get_change_tag_map(self):
-        tag_map = mwdeploy.get_change_tag_map()
-        self.assertIsInstance(tag_map, dict)
-        self.assertTrue(all(isinstance(pattern, type(re.compile(''))) for pattern in tag_map.keys()))
-        self.assertTrue(all(isinstance(tag, str) for tag in tag_map.values()))
+    def test_change_tags(self):
+        tags = set().union(*(mwdeploy.classify_change(file) for file in self.changed_files))
+        self.assertCountEqual(tags, mwdeploy.CHANGE_TAGS)
+        self.assertCountEqual(mwdeploy.get_change_index(self.path, self.version), mwdeploy.CHANGE_TAGS)
 
     @patch('os.popen')
     def test_get_changed_files(self, mock_popen):
-        mock_popen.return_value.readlines.return_value = self.changed_files
+        mock_popen.return_value.read.return_value = '\0'.join(self.changed_files) + '\0'
         changed_files = mwdeploy.get_changed_files(self.path, self.version)
         self.assertIsInstance(changed_files, list)
         self.assertCountEqual(changed_files, self.changed_files)
-        mock_popen.assert_called_with(f'git -C {self.repo_dir} --no-pager --git-dir={self.repo_dir}/.git diff --name-only HEAD@{{1}} HEAD 2> /dev/null')
+        mock_popen.assert_called_with(f'git -C {self.repo_dir} --no-pager --git-dir={self.repo_dir}/.git -c core.quotePath=false diff --name-only -z --no-renames HEAD@{{1}} HEAD 2> /dev/null')
 
     @patch('os.popen')
     def test_get_changed_files_type(self, mock_popen):
-        mock_popen.return_value.readlines.return_value = self.changed_files
+        mock_popen.return_value.read.return_value = '\0'.join(self.changed_files) + '\0'
         codechange_files = mwdeploy.get_changed_files_type(self.path, self.version, 'code change')
         schema_files = mwdeploy.get_changed_files_type(self.path, self.version, 'schema change')
         build_files = mwdeploy.get_changed_files_type(self.path, self.version, 'build')
@@ -56,12 +62,23 @@ class TestTagFunctions(unittest.TestCase):
 
     @patch('os.popen')
     def test_get_change_tags(self, mock_popen):
-        mock_popen.return_value.readlines.return_value = self.changed_files
+        mock_popen.return_value.read.return_value = '\0'.join(self.changed_files) + '\0'
         tags = mwdeploy.get_change_tags(self.path, self.version)
         self.assertIsInstance(tags, set)
         self.assertTrue(all(isinstance(tag, str) for tag in tags))
         self.assertCountEqual(tags, {'code change', 'schema change', 'build', 'i18n'})
 
+    @patch('os.popen')
+    def test_change_index_single_diff(self, mock_popen):
+        mock_popen.return_value.read.return_value = '\0'.join(self.changed_files) + '\0'
+        mwdeploy.get_changed_files_type(self.path, self.version, 'schema change')
+        mwdeploy.get_changed_files_type(self.path, self.version, 'build')
+        mwdeploy.get_change_tags(self.path, self.version)
+        self.assertEqual(mock_popen.call_count, 1)
+        mwdeploy.clear_change_index(self.path, self.version)
+        mwdeploy.get_change_tags(self.path, self.version)
+        self.assertEqual(mock_popen.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -319,3 +336,910 @@ def test_ServersAction():
         parser.parse_args(['--servers', 'invalid_server'])
     namespace = parser.parse_args(['--servers', 'mw151,mw152'])
     assert namespace.servers == ['mw151', 'mw152']
+
+
+def test_get_sync_targets_stops_at_deploy_host() -> None:
+    with patch.object(mwdeploy, 'HOSTNAME', 'mw161'):
+        assert mwdeploy.get_sync_targets(['mw151', 'mw152', 'mw161', 'mw162']) == ['mw151', 'mw152']
+
+
+@pytest.mark.parametrize('parallel', [1, 4])
+def test_remote_sync_file_results(parallel: int) -> None:
+    envinfo = mwdeploy.get_environment_info()
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), \
+         patch.object(mwdeploy, 'run_command', side_effect=lambda cmd: 1 if 'mw152' in cmd else 0) as mock_run, \
+         patch.object(mwdeploy, 'check_up', return_value=True) as mock_check_up:
+        results = mwdeploy.remote_sync_file(time=False, serverlist=['mw151', 'mw152', 'mw161'], path='/srv/mediawiki/config/', envinfo=envinfo, nolog=True, parallel=parallel)
+    assert [result['server'] for result in results] == ['mw151', 'mw152', 'mw161']
+    assert [result['ec'] for result in results] == [0, 1, 0]
+    assert all(result['path'] == '/srv/mediawiki/config/' for result in results)
+    assert mock_run.call_count == 3
+    assert mock_check_up.call_count == 3
+
+
+def test_get_pull_status() -> None:
+    assert mwdeploy.get_pull_status({'repo': 'extensions/Cite', 'ec': 1, 'output': ''}) == 'failed'
+    assert mwdeploy.get_pull_status({'repo': 'extensions/Cite', 'ec': 0, 'output': 'Already up to date.'}) == 'up to date'
+    assert mwdeploy.get_pull_status({'repo': 'extensions/Cite', 'ec': 0, 'output': 'Already up to date.'}, force_upgrade=True) == 'upgraded'
+    assert mwdeploy.get_pull_status({'repo': 'extensions/Cite', 'ec': 0, 'output': 'Fast-forward'}) == 'upgraded'
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_upgrade_repos(jobs: int) -> None:
+    repos = ['extensions/Cite', 'extensions/Echo', 'extensions/Math', 'skins/Vector']
+    commands = []
+
+    def fake_run(repo: str, version: str, name: str, cmd: str, force: bool = False) -> dict:  # noqa: U100
+        commands.append(cmd)
+        if repo == 'extensions/Math':
+            return {'repo': repo, 'ec': 1, 'output': ''}
+        return {'repo': repo, 'ec': 0, 'output': 'Already up to date.' if repo == 'skins/Vector' else ''}
+
+    incoming = {'extensions/Cite': ['sql/cite.sql', 'src/Cite.php'], 'extensions/Echo': ['sql/echo.sql'], 'skins/Vector': []}
+    with patch.object(mwdeploy, '_run_repo_command', side_effect=fake_run), \
+            patch.object(mwdeploy, 'get_incoming_files', side_effect=lambda repo, version: incoming[repo]), \
+            patch('builtins.input', return_value='Cite') as mock_input:  # noqa: U100
+        results, heldback, approved = mwdeploy.upgrade_repos(repos, 'version', submodules={'extensions/Cite', 'extensions/Echo'}, jobs=jobs)
+    mock_input.assert_called_once()
+    # every fetch runs before the first merge, schema changes held back are never merged
+    assert commands[:4] == [mwdeploy._construct_git_fetch(repo, version='version') for repo in repos]
+    assert sorted(commands[4:]) == [mwdeploy._construct_git_merge('extensions/Cite', submodules=True, version='version'), mwdeploy._construct_git_merge('skins/Vector', version='version')]
+    assert [result['repo'] for result in results] == ['extensions/Cite', 'extensions/Math', 'skins/Vector']
+    assert heldback == {'extensions/Echo'}
+    assert approved == ['/srv/mediawiki-staging/version/extensions/Cite/sql/cite.sql']
+
+
+def test_upgrade_repos_schema_prompt() -> None:
+    repos = ['extensions/Cite', 'extensions/Echo']
+    with patch.object(mwdeploy, '_run_repo_command', side_effect=lambda repo, *args, **kwargs: {'repo': repo, 'ec': 0, 'output': ''}) as mock_run, \
+            patch.object(mwdeploy, 'get_incoming_files', return_value=['sql/table.sql']):  # noqa: U100
+        with patch('builtins.input', return_value='y'):
+            results, heldback, approved = mwdeploy.upgrade_repos(repos, 'version')
+        assert (len(results), heldback, len(approved)) == (2, set(), 2)
+        with patch('builtins.input', return_value=''):
+            results, heldback, approved = mwdeploy.upgrade_repos(repos, 'version')
+        assert (results, heldback, approved) == ([], set(repos), [])
+        with patch('builtins.input') as mock_input:
+            results, heldback, approved = mwdeploy.upgrade_repos(repos, 'version', confirm=False)
+        mock_input.assert_not_called()
+        assert (len(results), heldback, approved) == (2, set(), [])
+        mock_run.reset_mock()
+        with patch('builtins.input', side_effect=KeyboardInterrupt), pytest.raises(SystemExit):
+            mwdeploy.upgrade_repos(repos, 'version')
+        # aborting at the prompt leaves every repository as it was
+        assert all(call.args[2] == 'git fetch' for call in mock_run.call_args_list)
+
+
+def test_construct_git_fetch_merge() -> None:
+    assert mwdeploy._construct_git_fetch('extensions/Cite', version='version') == 'sudo -u www-data git -C /srv/mediawiki-staging/version/extensions/Cite fetch --quiet'
+    assert mwdeploy._construct_git_merge('skins/Vector', version='version') == 'sudo -u www-data git -C /srv/mediawiki-staging/version/skins/Vector merge --ff-only @{u} 2> /dev/null'
+    assert mwdeploy._construct_git_merge('extensions/Cite', submodules=True, version='version').endswith(' && sudo -u www-data git -C /srv/mediawiki-staging/version/extensions/Cite submodule update --init --recursive --quiet')
+
+
+def test_get_staging_repos_cached(tmp_path) -> None:
+    extensions = tmp_path / 'extensions'
+    for name in ('Cite', 'Echo'):
+        (extensions / name / '.git').mkdir(parents=True)
+    (extensions / 'README').write_text('')
+    index_file = str(tmp_path / 'cache' / 'repo-index.json')
+
+    with patch.object(mwdeploy, 'CACHE_DIR', str(tmp_path / 'cache')), \
+         patch.object(mwdeploy, 'REPO_INDEX_FILE', index_file), \
+         patch.dict(mwdeploy._repo_index, clear=True):
+        assert sorted(mwdeploy.get_staging_repos(str(extensions))) == ['Cite', 'Echo']
+        assert os.path.exists(index_file)
+
+        with patch('os.scandir') as mock_scandir:
+            assert sorted(mwdeploy.get_staging_repos(str(extensions))) == ['Cite', 'Echo']
+        mock_scandir.assert_not_called()
+
+        (extensions / 'Math' / '.git').mkdir(parents=True)
+        stat = os.stat(extensions)
+        os.utime(extensions, (stat.st_atime, stat.st_mtime + 1))
+        assert sorted(mwdeploy.get_staging_repos(str(extensions))) == ['Cite', 'Echo', 'Math']
+
+
+@pytest.mark.parametrize(('path', 'tags'), [
+    ('includes/Hooks.php', {'code change'}),
+    ('resources/src/App.vue', {'code change'}),
+    ('types.d.ts', {'code change'}),
+    ('src/types.ts', set()),
+    ('extension-repo.json', {'code change'}),
+    ('sql/mysql/patch-add-index.sql', {'schema change'}),
+    ('tests/phpunit/HooksTest.php', {'build'}),
+    ('mytests/a.php', {'build'}),
+    ('sql/tests/a.sql', {'build'}),
+    ('.github/workflows/ci.yml', {'build'}),
+    ('foo.svgo.config.js', {'build'}),
+    ('package-lock.json', {'build'}),
+    ('i18n/en.json', {'i18n'}),
+    ('i18n/.json', {'i18n'}),
+    ('modules/i18n/api/qqq.json', {'i18n'}),
+    ('tests/i18n/en.json', {'build', 'i18n'}),
+    ('README.md', set()),
+])
+def test_classify_change(path: str, tags: set[str]) -> None:
+    assert mwdeploy.classify_change(path) == tags
+
+
+def test_construct_rsync_released_tree_not_inplace() -> None:
+    # /srv/mediawiki/version was deployed with --releases, its files are hardlinked to the retained releases
+    released = {'/srv/mediawiki/releases/version'}
+    with patch.object(mwdeploy.os.path, 'isdir', side_effect=lambda path: path in released), patch.object(mwdeploy, '_relay_agent_socket', '/tmp/agent'):
+        assert mwdeploy._construct_rsync_command(time=True, dest='/srv/mediawiki/version/', location='/srv/mediawiki-staging/version/') == 'sudo -u www-data rsync -r --delete --exclude=".*" /srv/mediawiki-staging/version/ /srv/mediawiki/version/'
+        assert mwdeploy._construct_rsync_command(time=True, dest='/srv/mediawiki/version/extensions/Cite/', local=False, server='meta') == 'sudo -u www-data rsync -r --delete -e "ssh -i /srv/mediawiki-staging/deploykey" /srv/mediawiki/version/extensions/Cite/ www-data@meta.wikitide.net:/srv/mediawiki/version/extensions/Cite/'
+        assert '--inplace' not in mwdeploy._construct_relay_command(True, '/srv/mediawiki/version/', 'mw151', 'mw152')
+        assert mwdeploy._construct_rsync_command(time=True, dest='/srv/mediawiki/config/', local=False, server='meta').startswith('sudo -u www-data rsync --inplace ')
+        assert not mwdeploy.is_released_path('/srv/mediawiki/')
+
+
+def test_construct_rsync_local_files_from() -> None:
+    assert mwdeploy._construct_rsync_command(time=False, dest='/srv/mediawiki/version/extensions/Cite/', location='/srv/mediawiki-staging/version/extensions/Cite/', files_from='/tmp/cite.list') == 'sudo -u www-data rsync --update --files-from=/tmp/cite.list --delete-missing-args --exclude=".*" /srv/mediawiki-staging/version/extensions/Cite/ /srv/mediawiki/version/extensions/Cite/'
+
+
+def test_construct_rsync_remote_files_from() -> None:
+    assert mwdeploy._construct_rsync_command(time=True, dest='/srv/mediawiki/version/extensions/Cite/', local=False, server='meta', files_from='/tmp/cite.list') == 'sudo -u www-data rsync --inplace --files-from=/tmp/cite.list --delete-missing-args -e "ssh -i /srv/mediawiki-staging/deploykey" /srv/mediawiki/version/extensions/Cite/ www-data@meta.wikitide.net:/srv/mediawiki/version/extensions/Cite/'
+
+
+def test_get_incremental_file_list() -> None:
+    files = ['includes/Hooks.php', 'i18n/en.json']
+    with patch.object(mwdeploy, 'get_cached_changed_files', return_value=files), patch('os.path.isdir', return_value=False):
+        assert mwdeploy.get_incremental_file_list('extensions/Cite', 'version') == files
+    with patch.object(mwdeploy, 'get_cached_changed_files', return_value=['lib/ve']), patch('os.path.isdir', return_value=True):
+        assert mwdeploy.get_incremental_file_list('extensions/VisualEditor', 'version') is None
+    with patch.object(mwdeploy, 'get_cached_changed_files', return_value=[]):
+        assert mwdeploy.get_incremental_file_list('extensions/Cite', 'version') is None
+
+
+def test_get_changed_files_lists_both_sides_of_renames(tmp_path) -> None:
+    def git(*args: str) -> None:
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.org', *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git('init', '-q')
+    (tmp_path / 'old.php').write_text('<?php\nclass Old {}\n')
+    git('add', '-A')
+    git('commit', '-q', '-m', 'Initial commit')
+    git('mv', 'old.php', 'new.php')
+    git('commit', '-q', '-m', 'Rename')
+    # the old path has to reach --files-from for --delete-missing-args to remove it
+    assert sorted(mwdeploy.get_changed_files(str(tmp_path), 'version')) == ['new.php', 'old.php']
+
+
+def test_get_changed_files_non_ascii(tmp_path) -> None:
+    def git(*args: str) -> None:
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.org', *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git('init', '-q')
+    (tmp_path / 'README').write_text('')
+    git('add', '-A')
+    git('commit', '-q', '-m', 'Initial commit')
+    (tmp_path / 'i18n').mkdir()
+    (tmp_path / 'i18n' / 'é.json').write_text('{}')
+    (tmp_path / 'sql').mkdir()
+    (tmp_path / 'sql' / 'patch-ü.sql').write_text('')
+    git('add', '-A')
+    git('commit', '-q', '-m', 'Add files')
+    files = mwdeploy.get_changed_files(str(tmp_path), 'version')
+    # the real names, not C-quoted ones, reach --files-from and the classifier
+    assert sorted(files) == ['i18n/é.json', 'sql/patch-ü.sql']
+    assert mwdeploy.classify_change('sql/patch-ü.sql') == {'schema change'}
+
+
+def test_get_incoming_files_non_ascii(tmp_path) -> None:
+    def git(cwd: str, *args: str) -> None:
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.org', *args], cwd=cwd, check=True, capture_output=True)
+
+    upstream = tmp_path / 'upstream'
+    upstream.mkdir()
+    git(str(upstream), 'init', '-q')
+    (upstream / 'README').write_text('')
+    git(str(upstream), 'add', '-A')
+    git(str(upstream), 'commit', '-q', '-m', 'Initial commit')
+    git(str(tmp_path), 'clone', '-q', str(upstream), 'staging')
+    (upstream / 'sql').mkdir()
+    (upstream / 'sql' / 'patch-ü.sql').write_text('')
+    git(str(upstream), 'add', '-A')
+    git(str(upstream), 'commit', '-q', '-m', 'Add a schema change')
+    git(str(tmp_path / 'staging'), 'fetch', '-q')
+    with patch.object(mwdeploy, '_get_staging_path', return_value=str(tmp_path / 'staging')):
+        files = mwdeploy.get_incoming_files('extensions/Example', 'version')
+    # a C-quoted name would slip past the schema change prompt
+    assert files == ['sql/patch-ü.sql']
+    assert 'schema change' in mwdeploy.classify_change(files[0])
+
+
+def test_write_file_list() -> None:
+    filelist = mwdeploy.write_file_list(['includes/Hooks.php', 'i18n/en.json'])
+    with open(filelist) as listfile:
+        assert listfile.read() == 'includes/Hooks.php\ni18n/en.json\n'
+    assert os.stat(filelist).st_mode & 0o777 == 0o644
+    os.remove(filelist)
+
+
+def test_build_manifest(tmp_path) -> None:
+    tree = tmp_path / 'config'
+    (tree / 'sub').mkdir(parents=True)
+    (tree / 'LocalSettings.php').write_text('<?php')
+    (tree / 'sub' / 'a.json').write_text('{}')
+    with patch.object(mwdeploy, 'MANIFEST_DIR', str(tmp_path / 'manifests')):
+        manifest = mwdeploy.build_manifest(str(tree))
+        assert sorted(manifest) == ['LocalSettings.php', os.path.join('sub', 'a.json')]
+        assert manifest['LocalSettings.php']['size'] == 5
+        digest = mwdeploy.get_manifest_digest(manifest)
+
+        with patch.object(mwdeploy, '_hash_file') as mock_hash:
+            assert mwdeploy.get_path_digest(str(tree)) == digest
+        mock_hash.assert_not_called()
+
+        (tree / 'LocalSettings.php').write_text('<?php // changed')
+        assert mwdeploy.get_path_digest(str(tree)) != digest
+
+
+def test_remote_sync_file_skip_unchanged(tmp_path) -> None:
+    tree = tmp_path / 'config'
+    tree.mkdir()
+    (tree / 'LocalSettings.php').write_text('<?php')
+    envinfo = mwdeploy.get_environment_info()
+    with patch.object(mwdeploy, 'MANIFEST_DIR', str(tmp_path / 'manifests')), \
+         patch.object(mwdeploy, 'PUSHED_MANIFEST_FILE', str(tmp_path / 'pushed.json')), \
+         patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), \
+         patch.object(mwdeploy, 'check_up', return_value=True), \
+         patch.object(mwdeploy, 'run_command', side_effect=lambda cmd: 1 if 'mw152' in cmd else 0) as mock_run:
+        mwdeploy.remote_sync_file(time=False, serverlist=['mw151', 'mw152'], path=str(tree), envinfo=envinfo, nolog=True, skip_unchanged=True)
+        assert mock_run.call_count == 2
+        results = mwdeploy.remote_sync_file(time=False, serverlist=['mw151', 'mw152'], path=str(tree), envinfo=envinfo, nolog=True, skip_unchanged=True)
+        # mw151 already has this tree, mw152 failed last time
+        assert mock_run.call_count == 3
+        assert [result['server'] for result in results] == ['mw151', 'mw152']
+
+
+def test_remote_sync_file_forgets_overwritten_push(tmp_path) -> None:
+    tree = tmp_path / 'config'
+    tree.mkdir()
+    (tree / 'LocalSettings.php').write_text('<?php')
+    pushedfile = tmp_path / 'shared' / 'pushed.json'
+    envinfo = mwdeploy.get_environment_info()
+    with patch.object(mwdeploy, 'MANIFEST_DIR', str(tmp_path / 'manifests')), \
+         patch.object(mwdeploy, 'PUSHED_MANIFEST_FILE', str(pushedfile)), \
+         patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), \
+         patch.object(mwdeploy, 'check_up', return_value=True), \
+         patch.object(mwdeploy, 'run_command', return_value=0) as mock_run:
+        umask = os.umask(0o022)
+        try:
+            mwdeploy.remote_sync_file(time=False, serverlist=['mw151'], path=str(tree), envinfo=envinfo, nolog=True, skip_unchanged=True)
+        finally:
+            os.umask(umask)
+        assert json.loads(pushedfile.read_text()) == {'mw151': {str(tree): mwdeploy.get_path_digest(str(tree))}}
+        # writable by the other deployers on the host whatever the umask
+        assert pushedfile.parent.stat().st_mode & 0o7777 == 0o2775
+        assert pushedfile.stat().st_mode & 0o777 == 0o664
+        assert (tmp_path / 'shared' / 'pushed.json.lock').stat().st_mode & 0o777 == 0o664
+        # another deployer pushes a different tree without --skip-unchanged
+        mwdeploy.remote_sync_file(time=False, serverlist=['mw151'], path=str(tree), envinfo=envinfo, nolog=True)
+        assert json.loads(pushedfile.read_text()) == {'mw151': {}}
+        mwdeploy.remote_sync_file(time=False, serverlist=['mw151'], path=str(tree), envinfo=envinfo, nolog=True, skip_unchanged=True)
+    assert mock_run.call_count == 3
+
+
+def test_remote_sync_file_unable_to_forget_push(tmp_path) -> None:
+    tree = tmp_path / 'config'
+    tree.mkdir()
+    pushedfile = tmp_path / 'pushed.json'
+    pushedfile.write_text(json.dumps({'mw151': {str(tree): 'digest'}}))
+    with patch.object(mwdeploy, 'PUSHED_MANIFEST_FILE', str(pushedfile)), patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), \
+            patch.object(mwdeploy, '_save_cache_file', return_value=False), patch.object(mwdeploy, 'run_command') as mock_run, \
+            pytest.raises(SystemExit) as e:
+        mwdeploy.remote_sync_file(time=False, serverlist=['mw151'], path=str(tree), envinfo=mwdeploy.get_environment_info(), nolog=True)
+    assert e.value.code == 1
+    # a stale record left behind would let another deployer skip mw151, so nothing is pushed
+    mock_run.assert_not_called()
+
+
+def test_get_canary_session() -> None:
+    session = mwdeploy.get_canary_session()
+    assert session is mwdeploy.get_canary_session()
+    adapter = session.get_adapter('https://meta.miraheze.org')
+    assert adapter.max_retries.total == mwdeploy.CANARY_RETRIES
+
+
+def test_check_up_request_error() -> None:
+    with patch.object(mwdeploy.get_canary_session(), 'get', side_effect=mwdeploy.requests.ConnectionError('down')) as mock_get:
+        assert not mwdeploy.check_up(nolog=True, Debug='mw151', force=True)
+        with pytest.raises(SystemExit) as e:
+            mwdeploy.check_up(nolog=True, Debug='mw151')
+    assert e.value.code == 3
+    assert mock_get.call_args.kwargs['timeout'] == mwdeploy.CANARY_TIMEOUT
+
+
+def test_probe_servers() -> None:
+    def fake_get(url: str, headers: dict, **kwargs) -> MagicMock:  # noqa: U100
+        server = headers['X-WikiTide-Debug']
+        return MagicMock(status_code=200 if server.startswith('mw151') else 503, text='miraheze', headers={'X-Served-By': server})
+
+    with patch.object(mwdeploy.get_canary_session(), 'get', side_effect=fake_get):
+        results = mwdeploy.probe_servers(['mw151', 'mw152'], domain='meta.miraheze.org')
+    assert [(result['server'], result['up'], result['status']) for result in results] == [('mw151', True, 200), ('mw152', False, 503)]
+
+
+def test_trace_span_disabled() -> None:
+    with patch.object(mwdeploy, '_trace_start', None), patch.object(mwdeploy, '_trace_events', []):
+        with mwdeploy.trace_span('stage'):
+            pass
+        assert mwdeploy._trace_events == []
+
+
+def test_trace_span_nested(tmp_path) -> None:
+    with patch.object(mwdeploy, '_trace_start', None), patch.object(mwdeploy, '_trace_events', []):
+        mwdeploy.start_trace()
+        with mwdeploy.trace_span('run_process', version='version'), patch('os.system', return_value=0):
+            mwdeploy.run_command('sudo -u www-data git -C /srv/mediawiki-staging/config/ pull --quiet')
+        trace_file = str(tmp_path / 'trace.json')
+        mwdeploy.write_trace(trace_file)
+
+    with open(trace_file) as trace:
+        events = [event for event in json.load(trace)['traceEvents'] if event['ph'] == 'X']
+    inner, outer = events
+    assert (outer['name'], inner['name']) == ('run_process', 'git')
+    assert inner['args']['ec'] == 0
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_add_step_names() -> None:
+    plan: dict = {}
+    first = mwdeploy.add_command_step(plan, 'stage', 'echo one', [])
+    second = mwdeploy.add_command_step(plan, 'stage', 'echo two', [first])
+    rsync = mwdeploy.add_command_step(plan, 'rsync', 'echo three', [second])
+    assert (first, second, rsync) == ('stage-1', 'stage-2', 'rsync-1')
+    assert plan['rsync-1']['deps'] == ['stage-2']
+    assert plan['rsync-1']['description'] == 'echo three'
+
+
+def test_execute_plan_order() -> None:
+    calls = []
+    plan: dict = {}
+
+    def step(name: str, ec: int = 0) -> list[int]:
+        calls.append(name)
+        return [ec]
+
+    mwdeploy.add_step(plan, 'stage', 'a', partial(step, 'a'), [])
+    mwdeploy.add_step(plan, 'rsync', 'b', partial(step, 'b'), ['stage-1'])
+    mwdeploy.add_step(plan, 'rsync', 'c', partial(step, 'c'), ['stage-1'])
+    mwdeploy.add_step(plan, 'rebuild', 'd', partial(step, 'd'), ['rsync-1', 'rsync-2'])
+    results = mwdeploy.execute_plan(plan, jobs=2)
+    assert calls[0] == 'a'
+    assert calls[-1] == 'd'
+    assert set(calls[1:3]) == {'b', 'c'}
+    assert results == {'stage-1': [0], 'rsync-1': [0], 'rsync-2': [0], 'rebuild-1': [0]}
+
+
+def test_execute_plan_traces_steps() -> None:
+    plan: dict = {}
+    mwdeploy.add_step(plan, 'stage', 'a', lambda: [0], [])
+    mwdeploy.add_step(plan, 'rsync', 'b', lambda: [0], ['stage-1'])
+    with patch.object(mwdeploy, '_trace_start', None), patch.object(mwdeploy, '_trace_events', []):
+        mwdeploy.start_trace()
+        mwdeploy.execute_plan(plan, jobs=2)
+        spans = {event['name']: event['args'] for event in mwdeploy._trace_events}
+    assert spans == {'stage-1': {'phase': 'stage'}, 'rsync-1': {'phase': 'rsync'}}
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_execute_plan_stops_after_failure(jobs: int) -> None:
+    calls = []
+    plan: dict = {}
+
+    def step(name: str, ec: int = 0) -> list[int]:
+        calls.append(name)
+        return [ec]
+
+    mwdeploy.add_step(plan, 'stage', 'a', partial(step, 'a', 1), [])
+    mwdeploy.add_step(plan, 'rsync', 'b', partial(step, 'b'), ['stage-1'])
+    mwdeploy.add_step(plan, 'remote', 'c', partial(step, 'c'), [])
+    results = mwdeploy.execute_plan(plan, jobs=jobs)
+    assert 'b' not in calls
+    assert results['stage-1'] == [1]
+    assert 'rsync-1' not in results
+
+
+def test_run_command_cwd() -> None:
+    with patch('os.system', return_value=0) as mock_system:
+        assert mwdeploy.run_command('composer update', cwd='/srv/mediawiki-staging/version/') == 0
+    mock_system.assert_called_once_with('cd /srv/mediawiki-staging/version/ && composer update')
+
+
+def test_prefixed_output() -> None:
+    stream = io.StringIO()
+    output = mwdeploy.PrefixedOutput(stream)
+
+    def pipeline() -> None:
+        mwdeploy._output.prefix = '[1.43] '
+        output.write('Execute: one\nCompleted')
+        output.write(' (0)\npartial')
+        output.flush()
+        mwdeploy._output.prefix = ''
+
+    thread = threading.Thread(target=pipeline)
+    thread.start()
+    thread.join()
+    output.write('main\n')
+    assert stream.getvalue() == '[1.43] Execute: one\n[1.43] Completed (0)\n[1.43] partial\nmain\n'
+
+
+def test_run_command_prefixed_output(capsys) -> None:
+    mwdeploy._output.prefix = '[1.43] '
+    try:
+        assert mwdeploy.run_command('echo hello; exit 3', cwd=os.getcwd()) == 3
+    finally:
+        mwdeploy._output.prefix = ''
+    assert 'hello\n' in capsys.readouterr().out
+
+
+def test_get_versions_cached(tmp_path) -> None:
+    cache_file = str(tmp_path / 'versions.json')
+    with patch.object(mwdeploy, 'VERSIONS_CACHE_FILE', cache_file), patch.dict(mwdeploy.versions, clear=True), patch('os.listdir', return_value=['1.43', '1.44', 'config']), patch('os.popen') as mock_popen:
+        mock_popen.return_value.read.return_value = '{"1.43": "1.43", "1.44": "1.44"}\n'
+        assert mwdeploy.get_versions() == {'1.43': '1.43', '1.44': '1.44'}
+        assert mwdeploy.get_repos()['errorpages'] == 'ErrorPages'
+        mwdeploy.versions.clear()
+        assert mwdeploy.get_versions() == {'1.43': '1.43', '1.44': '1.44'}
+        mock_popen.assert_called_once_with('/usr/local/bin/getMWVersions')
+
+        # the wiki moves to another version through config alone, the listing stays the same
+        mock_popen.return_value.read.return_value = '1.43\n'
+        assert mwdeploy.get_default_version() == '1.43'
+        mock_popen.return_value.read.return_value = '1.44\n'
+        assert mwdeploy.get_default_version() == '1.44'
+        assert mock_popen.call_count == 3
+
+    # a new staging directory invalidates the cache
+    with patch.object(mwdeploy, 'VERSIONS_CACHE_FILE', cache_file), patch.dict(mwdeploy.versions, clear=True), patch('os.listdir', return_value=['1.43', '1.44', '1.45', 'config']), patch('os.popen') as mock_popen:
+        mock_popen.return_value.read.return_value = '{"1.44": "1.44", "1.45": "1.45"}'
+        assert mwdeploy.get_versions() == {'1.44': '1.44', '1.45': '1.45'}
+
+
+def test_get_l10n_languages() -> None:
+    listings = {
+        '/srv/mediawiki/version/languages/messages': ['MessagesEn.php', 'MessagesZh_hans.php', 'README'],
+        '/srv/mediawiki/version/languages/i18n': ['en.json', 'fr.json', 'qqq.json', 'zh-hans.json'],
+    }
+    with patch('os.listdir', side_effect=lambda path: listings[path]):
+        assert mwdeploy.get_l10n_languages('version') == ['en', 'fr', 'zh-hans']
+
+
+def test_shard_languages() -> None:
+    assert mwdeploy.shard_languages(['de', 'en', 'fr', 'nl', 'pl'], 2) == [['de', 'fr', 'pl'], ['en', 'nl']]
+    assert mwdeploy.shard_languages(['de', 'en'], 4) == [['de'], ['en']]
+
+
+def test_get_l10n_rebuild_commands() -> None:
+    rebuild = 'sudo -u www-data php /srv/mediawiki/version/maintenance/rebuildLocalisationCache.php'
+    with patch.object(mwdeploy, 'get_l10n_languages', return_value=['de', 'en', 'fr']) as mock_languages:
+        assert mwdeploy.get_l10n_rebuild_commands('version', 2, None, '', 'testwiki') == [f'{rebuild} --lang=de,fr --quiet --wiki=testwiki', f'{rebuild} --lang=en --quiet --wiki=testwiki']
+        assert mwdeploy.get_l10n_rebuild_commands('version', 2, 'nl', '', 'testwiki') == [f'{rebuild} --lang=nl --quiet --wiki=testwiki']
+    assert mock_languages.call_count == 1
+    # an unreadable languages directory still rebuilds every language, just not in parallel
+    with patch.object(mwdeploy, 'get_l10n_languages', return_value=[]):
+        assert mwdeploy.get_l10n_rebuild_commands('version', 2, None, '', 'testwiki') == [f'{rebuild}  --quiet --wiki=testwiki']
+
+
+def test_run_commands_parallel() -> None:
+    with patch('os.system', side_effect=lambda cmd: 256 if 'fr' in cmd else 0):
+        assert mwdeploy.run_commands_parallel(['rebuild --lang=de', 'rebuild --lang=fr']) == [0, 256]
+
+
+def test_construct_archive_command() -> None:
+    with patch.object(mwdeploy, 'RELEASE_ID', 'r1'):
+        command = mwdeploy._construct_archive_command('/srv/mediawiki/cache/version/l10n/', 'meta')
+        unpack = mwdeploy._construct_archive_unpack('/srv/mediawiki/cache/version/l10n')
+    assert command == f'sudo -u www-data tar -C /srv/mediawiki/cache/version/l10n -czf - . | sudo -u www-data ssh -i /srv/mediawiki-staging/deploykey www-data@meta.wikitide.net {shlex.quote(unpack)}'
+    assert 'mv -T /srv/mediawiki/cache/version/l10n.mwdeploy-link /srv/mediawiki/cache/version/l10n' in unpack
+
+
+def test_archive_unpack_swaps_symlink(tmp_path) -> None:
+    target = tmp_path / 'l10n'
+    target.mkdir()
+    (target / 'old.cdb').write_text('old')
+    for release, content in (('r1', 'one'), ('r2', 'two')):
+        (tmp_path / 'src' / release).mkdir(parents=True)
+        (tmp_path / 'src' / release / 'en.cdb').write_text(content)
+        with patch.object(mwdeploy, 'RELEASE_ID', release):
+            script = mwdeploy._construct_archive_unpack(str(target))
+        archive = subprocess.run(['tar', '-C', str(tmp_path / 'src' / release), '-czf', '-', '.'], capture_output=True, check=True).stdout
+        subprocess.run(['sh', '-c', script], input=archive, check=True)
+        assert target.is_symlink()
+        assert (target / 'en.cdb').read_text() == content
+        assert not (target / 'old.cdb').exists()
+    # only the active copy is kept
+    assert sorted(path.name for path in tmp_path.iterdir() if path.name.startswith('l10n')) == ['l10n', 'l10n.mwdeploy-r2']
+
+
+@pytest.mark.parametrize(('threshold', 'archive'), [(0, False), (3, True), (4, False)])
+def test_remote_sync_file_archive_threshold(tmp_path, threshold: int, archive: bool) -> None:
+    for name in ('en.cdb', 'fr.cdb', 'de.cdb'):
+        (tmp_path / name).write_text('')
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), \
+         patch.object(mwdeploy, 'check_up', return_value=True), \
+         patch.object(mwdeploy, 'run_command', return_value=0) as mock_run:
+        mwdeploy.remote_sync_file(time=False, serverlist=['mw151'], path=f'{tmp_path}/', envinfo=mwdeploy.get_environment_info(), nolog=True, archive_threshold=threshold)
+    assert mock_run.call_args.args[0].startswith('sudo -u www-data tar') == archive
+
+
+def test_ssh_multiplexing() -> None:
+    with patch.object(mwdeploy, '_ssh_control_path', None), patch('os.system', return_value=0) as mock_system, patch('atexit.register') as mock_register:
+        mwdeploy.start_ssh_multiplexing(['mw151', 'mw152'])
+        control = f'-o ControlMaster=auto -o ControlPath=/tmp/mwdeploy-{os.getpid()}-%C -o ControlPersist=600'
+        assert mwdeploy.get_ssh_command() == f'ssh -i /srv/mediawiki-staging/deploykey {control}'
+        assert mock_system.call_count == 2
+        assert f'sudo -u www-data ssh -i /srv/mediawiki-staging/deploykey {control} -fN www-data@mw151.wikitide.net' in [call.args[0] for call in mock_system.call_args_list]
+        assert f'-e "ssh -i /srv/mediawiki-staging/deploykey {control}"' in mwdeploy._construct_rsync_command(time=False, dest='/srv/mediawiki/config/', local=False, server='mw151')
+        mock_register.assert_called_once_with(mwdeploy.stop_ssh_multiplexing, ['mw151', 'mw152'])
+
+        mwdeploy.stop_ssh_multiplexing(['mw151', 'mw152'])
+        assert mock_system.call_args.args[0] == f'sudo -u www-data ssh -o ControlPath=/tmp/mwdeploy-{os.getpid()}-%C -O exit www-data@mw152.wikitide.net 2> /dev/null'
+        assert mwdeploy.get_ssh_command() == 'ssh -i /srv/mediawiki-staging/deploykey'
+
+
+def test_plan_waves() -> None:
+    servers = ['mw151', 'mw152', 'mw161', 'mw162', 'mw171', 'mw172']
+    assert mwdeploy.plan_waves(servers, 1, 2) == [['mw151'], ['mw152', 'mw161'], ['mw162', 'mw171'], ['mw172']]
+    assert mwdeploy.plan_waves(servers, 2, 10) == [['mw151', 'mw152'], ['mw161', 'mw162', 'mw171', 'mw172']]
+    assert mwdeploy.plan_waves(servers[:1], 1, 3) == [['mw151']]
+
+
+def test_remote_sync_file_rollout_halts() -> None:
+    rollout: mwdeploy.RolloutConfig = {'wave_size': 2, 'canaries': 1, 'max_error_rate': 0.0, 'max_latency': 5.0}
+    probes = [
+        [{'server': 'mw151', 'up': True, 'status': 200, 'latency': 0.1}],
+        [{'server': 'mw151', 'up': True, 'status': 200, 'latency': 0.1}, {'server': 'mw152', 'up': False, 'status': 503, 'latency': 0.1}, {'server': 'mw161', 'up': True, 'status': 200, 'latency': 0.1}],
+    ]
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), \
+         patch.object(mwdeploy, 'check_up', return_value=True), \
+         patch.object(mwdeploy, 'probe_servers', side_effect=probes) as mock_probe, \
+         patch.object(mwdeploy, 'run_command', return_value=0) as mock_run:
+        results = mwdeploy.remote_sync_file(time=False, serverlist=['mw151', 'mw152', 'mw161', 'mw162', 'mw171'], path='/srv/mediawiki/config/', envinfo=mwdeploy.get_environment_info(), nolog=True, rollout=rollout)
+    assert mock_run.call_count == 3
+    assert mock_probe.call_args_list[1].args[0] == ['mw151', 'mw152', 'mw161']
+    assert [(result['server'], result['ec']) for result in results] == [('mw151', 0), ('mw152', 0), ('mw161', 0), ('mw162', 3), ('mw171', 3)]
+
+
+def test_execute_plan_resume() -> None:
+    calls = []
+    recorded = []
+    plan: dict = {}
+
+    def step(name: str) -> list[int]:
+        calls.append(name)
+        return [0]
+
+    mwdeploy.add_step(plan, 'stage', 'a', partial(step, 'a'), [])
+    mwdeploy.add_step(plan, 'rsync', 'b', partial(step, 'b'), ['stage-1'])
+    mwdeploy.add_step(plan, 'remote', 'c', partial(step, 'c'), ['rsync-1'])
+    results = mwdeploy.execute_plan(plan, completed={'stage-1': 'a', 'rsync-1': 'changed', 'remote-1': 'c'}, record=recorded.append)
+    assert calls == ['b', 'c']
+    assert recorded == ['rsync-1', 'remote-1']
+    assert results == {'stage-1': [0], 'rsync-1': [0], 'remote-1': [0]}
+
+
+def test_get_journal_file() -> None:
+    args = argparse.Namespace(config=True, servers=['mw151'], jobs=1, resume=False)
+    same = argparse.Namespace(config=True, servers=['mw151'], jobs=4, resume=True)
+    other = argparse.Namespace(config=True, servers=['mw152'], jobs=1, resume=False)
+    assert mwdeploy.get_journal_file(args) == mwdeploy.get_journal_file(same)
+    assert mwdeploy.get_journal_file(args) != mwdeploy.get_journal_file(other)
+    assert mwdeploy.get_journal_file(args) != mwdeploy.get_journal_file(args, '1.43')
+
+
+def test_load_journal(tmp_path) -> None:
+    journal_file = str(tmp_path / 'journal.json')
+    heads = {'/srv/mediawiki-staging/config/': 'abc'}
+    assert mwdeploy.load_journal(journal_file, heads)['completed'] == {}
+    plan: dict = {}
+    mwdeploy.add_step(plan, 'stage', 'git pull config', partial(list), [])
+    mwdeploy.add_step(plan, 'stage', 'git pull landing', partial(list), ['stage-1'])
+    mwdeploy.add_step(plan, 'rsync', 'rsync config', partial(list), ['stage-2'])
+    journal: mwdeploy.DeployJournal = {'heads': heads, 'upgraded': ['extensions/Echo'], 'completed': {}}
+    with patch.object(mwdeploy, 'get_git_head', return_value='def') as mock_head:
+        for name in plan:
+            mwdeploy.record_journal_step(journal_file, journal, plan, name)
+    # heads are taken once, after the last stage step
+    mock_head.assert_called_once()
+    assert mwdeploy.load_journal(journal_file, heads)['completed'] == {}
+    resumed = mwdeploy.load_journal(journal_file, {'/srv/mediawiki-staging/config/': 'def'})
+    assert resumed['completed'] == {'stage-1': 'git pull config', 'stage-2': 'git pull landing', 'rsync-1': 'rsync config'}
+    assert resumed['upgraded'] == ['extensions/Echo']
+
+
+def test_get_inputs_fingerprint(tmp_path) -> None:
+    composer = tmp_path / 'composer.json'
+    composer.write_text('{}')
+    files = [str(composer), str(tmp_path / 'composer.lock')]
+    fingerprint = mwdeploy.get_inputs_fingerprint(files)
+    assert mwdeploy.get_inputs_fingerprint(list(reversed(files))) == fingerprint
+    (tmp_path / 'composer.lock').write_text('{}')
+    assert mwdeploy.get_inputs_fingerprint(files) != fingerprint
+
+
+def test_run_fingerprinted_composer(tmp_path) -> None:
+    staging = tmp_path / 'staging'
+    (staging / 'extensions' / 'Echo').mkdir(parents=True)
+    (staging / 'vendor').mkdir()
+    (staging / 'composer.json').write_text('{}')
+    (staging / 'extensions' / 'Echo' / 'composer.json').write_text('{}')
+    plan: dict = {}
+    mwdeploy.add_command_step(plan, 'stage', 'composer update', [], cwd=str(staging), inputs=mwdeploy.get_composer_inputs(str(staging)))
+    with patch.object(mwdeploy, 'FINGERPRINT_FILE', str(tmp_path / 'fingerprints.json')), patch.object(mwdeploy, 'run_command', return_value=0) as mock_run:
+        assert plan['stage-1']['action']() == [0]
+        assert plan['stage-1']['action']() == [0]
+        assert mock_run.call_count == 1
+        (staging / 'extensions' / 'Echo' / 'composer.json').write_text('{"require": {}}')
+        assert plan['stage-1']['action']() == [0]
+        assert mock_run.call_count == 2
+        mock_run.return_value = 1
+        (staging / 'composer.json').write_text('{"require": {}}')
+        assert plan['stage-1']['action']() == [1]
+        assert plan['stage-1']['action']() == [1]
+
+
+def test_run_fingerprinted_outputs_and_repos(tmp_path) -> None:
+    (tmp_path / 'extensions' / 'Echo' / 'i18n').mkdir(parents=True)
+    (tmp_path / 'extensions' / 'Echo' / 'i18n' / 'en.json').write_text('{}')
+    output = tmp_path / 'l10n'
+    inputs: mwdeploy.StepInputs = {'inputs': [str(tmp_path / 'extensions' / '*' / 'i18n')], 'repos': [str(tmp_path / 'extensions' / '*')], 'trees': [], 'outputs': [str(output)]}
+    calls = []
+
+    def action() -> list[int]:
+        calls.append(True)
+        output.mkdir(exist_ok=True)
+        return [0]
+
+    with patch.object(mwdeploy, 'FINGERPRINT_FILE', str(tmp_path / 'fingerprints.json')), patch.object(mwdeploy, 'get_git_head', return_value='abc') as mock_head:
+        mwdeploy.run_fingerprinted('l10n', action, inputs)
+        mwdeploy.run_fingerprinted('l10n', action, inputs)
+        assert len(calls) == 1
+        output.rmdir()
+        mwdeploy.run_fingerprinted('l10n', action, inputs)
+        assert len(calls) == 2
+        (tmp_path / 'extensions' / 'Echo' / 'i18n' / 'de.json').write_text('{}')
+        mwdeploy.run_fingerprinted('l10n', action, inputs)
+        assert len(calls) == 3
+        mock_head.return_value = 'def'
+        mwdeploy.run_fingerprinted('l10n', action, inputs)
+        assert len(calls) == 4
+
+
+def test_run_fingerprinted_deployed_tree(tmp_path) -> None:
+    deployed = tmp_path / 'deployed'
+    (deployed / 'languages').mkdir(parents=True)
+    (deployed / 'languages' / 'Language.php').write_text('<?php')
+    output = tmp_path / 'l10n'
+    output.mkdir()
+    inputs: mwdeploy.StepInputs = {'inputs': [], 'repos': [], 'trees': [f'{deployed}/'], 'outputs': [str(output)]}
+    action = MagicMock(return_value=[0])
+    key = f'php {deployed}/maintenance/rebuildLocalisationCache.php'
+    with patch.object(mwdeploy, 'FINGERPRINT_FILE', str(tmp_path / 'state' / 'fingerprints.json')), patch.object(mwdeploy, 'MANIFEST_DIR', str(tmp_path / 'manifests')):
+        mwdeploy.run_fingerprinted(key, action, inputs)
+        mwdeploy.run_fingerprinted(key, action, inputs)
+        assert action.call_count == 1
+        # the deployed tree changed while staging did not, e.g. after an aborted sync
+        (deployed / 'languages' / 'Language.php').write_text('<?php // older')
+        mwdeploy.run_fingerprinted(key, action, inputs)
+        assert action.call_count == 2
+        # --rollback forgets every step run against the tree
+        mwdeploy.forget_fingerprints(f'{deployed}/')
+        mwdeploy.run_fingerprinted(key, action, inputs)
+        assert action.call_count == 3
+
+
+def test_construct_rsync_command_release_dest() -> None:
+    assert mwdeploy._construct_rsync_command(time=True, location='/srv/mediawiki-staging/1.43/*', dest='/srv/mediawiki/1.43/', release_dest='/srv/mediawiki/releases/1.43/r1/') == 'sudo -u www-data rsync -r --delete --exclude=".*" /srv/mediawiki-staging/1.43/* /srv/mediawiki/releases/1.43/r1/'
+    assert mwdeploy._construct_upgrade_rsync('extensions/Echo', '1.43', False, release='r1') == ('sudo -u www-data rsync --update -r --delete --exclude=".*" /srv/mediawiki-staging/1.43/extensions/Echo/* /srv/mediawiki/releases/1.43/r1/extensions/Echo/', None)
+
+
+def test_release_scripts(tmp_path) -> None:
+    root = str(tmp_path / 'mediawiki' / '1.43')
+    releases = str(tmp_path / 'mediawiki' / 'releases' / '1.43')
+    os.makedirs(root)
+    with open(f'{root}/index.php', 'w') as file:
+        file.write('old')
+
+    def deploy(release: str, content: str) -> None:
+        subprocess.run(mwdeploy._construct_release_prepare(root, release), shell=True, check=True)
+        # rsync replaces files, it never writes into the hardlinked ones
+        with open(f'{releases}/{release}/index.php.tmp', 'w') as file:
+            file.write(content)
+        os.replace(f'{releases}/{release}/index.php.tmp', f'{releases}/{release}/index.php')
+        subprocess.run(mwdeploy._construct_release_activate(root, release, 2), shell=True, check=True)
+
+    deploy('r1', 'new')
+    assert os.readlink(root) == f'{releases}/r1'
+    with open(f'{releases}/0-initial/index.php') as file:
+        assert file.read() == 'old'
+    deploy('r2', 'newer')
+    assert sorted(os.listdir(releases)) == ['r1', 'r2']
+    assert subprocess.run(mwdeploy._construct_release_rollback(root), shell=True, stdout=subprocess.DEVNULL).returncode == 0
+    with open(f'{root}/index.php') as file:
+        assert file.read() == 'new'
+    assert subprocess.run(mwdeploy._construct_release_rollback(root), shell=True, stdout=subprocess.DEVNULL).returncode != 0
+    assert os.readlink(root) == f'{releases}/r1'
+
+
+def test_remote_sync_file_release() -> None:
+    release: mwdeploy.ReleaseConfig = {'release': 'r1', 'keep': 3, 'paths': ['/srv/mediawiki/1.43/extensions/Echo/', '/srv/mediawiki/1.43/skins/Vector/'], 'files_from': {'/srv/mediawiki/1.43/skins/Vector/': '/tmp/list'}}
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), patch.object(mwdeploy, 'check_up', return_value=True), patch.object(mwdeploy, 'run_command', return_value=0) as mock_run:
+        results = mwdeploy.remote_sync_file(time=False, serverlist=['mw151'], path='/srv/mediawiki/1.43/', envinfo=mwdeploy.get_environment_info(), nolog=True, release=release, archive_threshold=1)
+    assert [result['ec'] for result in results] == [0]
+    prepare, echo, vector, activate = mock_run.call_args.args[0].split(' && sudo')
+    assert prepare.startswith("sudo -u www-data ssh -i /srv/mediawiki-staging/deploykey www-data@mw151.wikitide.net 'mkdir -p /srv/mediawiki/releases/1.43 && ")
+    assert echo.endswith('/srv/mediawiki/1.43/extensions/Echo/ www-data@mw151.wikitide.net:/srv/mediawiki/releases/1.43/r1/extensions/Echo/')
+    assert '--files-from=/tmp/list' in vector
+    assert vector.endswith('www-data@mw151.wikitide.net:/srv/mediawiki/releases/1.43/r1/skins/Vector/')
+    assert 'mv -T /srv/mediawiki/1.43.mwdeploy-link /srv/mediawiki/1.43' in activate
+
+
+def test_plan_relay_round() -> None:
+    servers = ['mw151', 'mw152', 'mw161', 'mw162', 'mw171']
+    assert mwdeploy.plan_relay_round(servers, [None], 1) == {'mw151': None}
+    assert mwdeploy.plan_relay_round(servers[1:], [None, 'mw151'], 1) == {'mw152': None, 'mw161': 'mw151'}
+    assert mwdeploy.plan_relay_round(servers[1:], [None, 'mw151'], 2) == {'mw152': None, 'mw161': None, 'mw162': 'mw151', 'mw171': 'mw151'}
+
+
+def test_construct_relay_command() -> None:
+    # multiplexing is on by default, the hop must still not go through its master
+    with patch.object(mwdeploy, '_relay_agent_socket', '/tmp/agent'), patch.object(mwdeploy, '_ssh_control_path', '/tmp/mwdeploy-1-%C'):
+        command = mwdeploy._construct_relay_command(False, '/srv/mediawiki/config/', 'mw151', 'mw152')
+    assert command == "sudo -u www-data env SSH_AUTH_SOCK=/tmp/agent ssh -i /srv/mediawiki-staging/deploykey -o ControlPath=none -A www-data@mw151.wikitide.net 'rsync --update -r --delete -e ssh /srv/mediawiki/config/ www-data@mw152.wikitide.net:/srv/mediawiki/config/'"
+    with patch.object(mwdeploy, '_relay_agent_socket', None), pytest.raises(Exception, match='relay agent'):
+        mwdeploy._construct_relay_command(False, '/srv/mediawiki/config/', 'mw151', 'mw152')
+
+
+def test_start_relay_agent() -> None:
+    with patch.object(mwdeploy, '_relay_agent_socket', None), patch('subprocess.Popen') as mock_popen, patch('atexit.register') as mock_register, \
+            patch('os.path.exists', return_value=True), patch.object(mwdeploy, 'run_command', return_value=0) as mock_run:
+        mwdeploy.start_relay_agent()
+        agent_socket = f'/tmp/mwdeploy-{os.getpid()}-agent'
+        assert mwdeploy._relay_agent_socket == agent_socket
+        assert mock_popen.call_args.args[0] == ['sudo', '-u', 'www-data', 'ssh-agent', '-D', '-a', agent_socket, '-t', '3600']
+        mock_run.assert_called_once_with(f'sudo -u www-data env SSH_AUTH_SOCK={agent_socket} ssh-add -q /srv/mediawiki-staging/relaykey')
+        mock_register.assert_called_once_with(mwdeploy.stop_relay_agent, mock_popen.return_value)
+        mwdeploy.stop_relay_agent(mock_popen.return_value)
+        mock_popen.return_value.terminate.assert_called_once()
+        assert mwdeploy._relay_agent_socket is None
+        # no key, no relaying: stop before anything is deployed
+        mock_run.return_value = 1
+        with pytest.raises(SystemExit):
+            mwdeploy.start_relay_agent()
+        assert mwdeploy._relay_agent_socket is None
+
+
+def test_remote_sync_file_relay(tmp_path) -> None:
+    servers = ['mw151', 'mw152', 'mw161', 'mw162', 'mw171']
+    path = f'{tmp_path}/srv/mediawiki/config/'
+    commands: list[str] = []
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), patch.object(mwdeploy, 'check_up', return_value=True), \
+            patch.object(mwdeploy, 'run_command', side_effect=lambda command: commands.append(command) or 0), \
+            patch.object(mwdeploy, '_relay_agent_socket', '/tmp/agent'), patch.object(mwdeploy, '_ssh_control_path', '/tmp/mwdeploy-1-%C'):
+        results = mwdeploy.remote_sync_file(time=False, serverlist=servers, path=path, envinfo=mwdeploy.get_environment_info(), nolog=True, relay_fanout=1)
+    assert sorted(result['server'] for result in results) == servers
+    assert all(result['ec'] == 0 for result in results)
+    # three rounds: the deploy host pushes once per round, the other pushes are relayed
+    direct = [command for command in commands if command.startswith('sudo -u www-data rsync')]
+    relayed = [command for command in commands if ' -A www-data@' in command]
+    assert len(direct) == 3
+    assert len(relayed) == 2
+    assert all('ControlMaster=auto' in command for command in direct)
+    assert all('-o ControlPath=none' in command and 'ControlMaster' not in command for command in relayed)
+
+
+def test_parse_rsync_progress() -> None:
+    assert mwdeploy.parse_rsync_progress('      1,238,099  45%  146.38MB/s    0:00:12 (xfr#5, to-chk=12/60)') == {'transferred': 1238099, 'percent': 45, 'rate': 146.38 * 1024 ** 2, 'eta': '0:00:12', 'files': 5}
+    assert mwdeploy.parse_rsync_progress('          32,768   0%    0.00kB/s    0:00:00') == {'transferred': 32768, 'percent': 0, 'rate': 0.0, 'eta': '0:00:00', 'files': 0}
+    assert mwdeploy.parse_rsync_progress('sent 1,234 bytes  received 56 bytes') is None
+
+
+def test_find_stragglers() -> None:
+    started = mwdeploy.time.time() - mwdeploy.STRAGGLER_GRACE
+    transfers: list[mwdeploy.TransferProgress] = [
+        {'server': server, 'transferred': 0, 'percent': 0, 'rate': rate, 'eta': '', 'files': 0, 'started': started, 'done': done, 'deferred': False}
+        for server, rate, done in [('mw151', 100.0, False), ('mw152', 90.0, True), ('mw161', 20.0, False), ('mw162', 40.0, True)]
+    ]
+    assert mwdeploy.find_stragglers(transfers, 0.5) == ['mw161']
+    assert mwdeploy.find_stragglers(transfers, 0) == []
+    assert mwdeploy.find_stragglers(transfers[:2], 0.5) == []
+    transfers[2]['started'] = mwdeploy.time.time()
+    assert mwdeploy.find_stragglers(transfers, 0.5) == []
+
+
+@pytest.fixture
+def transfers(monkeypatch) -> dict:
+    # the transfer table is module state, every test starts from an empty one
+    table: dict = {}
+    monkeypatch.setattr(mwdeploy, '_transfers', table)
+    return table
+
+
+def test_run_transfer_progress(capsys, transfers: dict) -> None:
+    progress: mwdeploy.ProgressConfig = {'straggler_ratio': 0.5, 'defer': False}
+    cmd = r"printf '  1,024  50%%  1.00kB/s  0:00:01 (xfr#1, to-chk=1/2)\r  2,048 100%%  2.00kB/s  0:00:00 (xfr#2, to-chk=0/2)\nsent 2,048 bytes\n'"
+    with patch.object(mwdeploy, '_transfers_shown', 0.0):
+        assert mwdeploy.run_transfer(cmd, 'mw151', '/srv/mediawiki/config/', progress) == 0
+    transfer = transfers[('mw151', '/srv/mediawiki/config/')]
+    assert (transfer['transferred'], transfer['files'], transfer['done']) == (2048, 2, True)
+    output = capsys.readouterr().out
+    assert 'sent 2,048 bytes' in output
+    assert 'mw151          50%     1.0KiB       1     1.0KiB/s  0:00:01' in output
+
+
+def test_remote_sync_file_defers_stragglers(transfers: dict) -> None:
+    path = '/srv/mediawiki/config/'
+    calls = []
+
+    def run_transfer(cmd: str, server: str, synced: str, progress: mwdeploy.ProgressConfig) -> int:  # noqa: U100
+        calls.append((server, progress['defer']))
+        transfers[(server, synced)] = {'server': server, 'transferred': 0, 'percent': 0, 'rate': 0.0, 'eta': '', 'files': 0, 'started': 0.0, 'done': True, 'deferred': server == 'mw151' and progress['defer']}
+        return -15 if transfers[(server, synced)]['deferred'] else 0
+
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), patch.object(mwdeploy, 'check_up', return_value=True) as mock_check_up, patch.object(mwdeploy, 'run_transfer', side_effect=run_transfer):
+        results = mwdeploy.remote_sync_file(time=False, serverlist=['mw151', 'mw152', 'mw161'], path=path, envinfo=mwdeploy.get_environment_info(), nolog=True, progress={'straggler_ratio': 0.5, 'defer': True})
+    assert calls == [('mw151', True), ('mw152', True), ('mw161', True), ('mw151', False)]
+    assert [(result['server'], result['ec']) for result in results] == [('mw151', 0), ('mw152', 0), ('mw161', 0)]
+    assert mock_check_up.call_count == 3
+
+
+def test_adjust_controller() -> None:
+    controller: mwdeploy.SyncController = {'workers': 2, 'max_workers': 3, 'bwlimit': 0, 'min_bwlimit': 1024, 'max_bwlimit': 0, 'latency_target': 1.0, 'throughput': 0.0}
+    controller = mwdeploy.adjust_controller(controller, 20 * 1024 ** 2, 0.2)
+    assert (controller['workers'], controller['bwlimit'], controller['throughput']) == (3, 0, 20 * 1024 ** 2)
+    # no gain from the extra transfer, the link is saturated
+    assert mwdeploy.adjust_controller(controller, 21 * 1024 ** 2, 0.2)['workers'] == 3
+    controller['workers'] = 2
+    assert mwdeploy.adjust_controller(controller, 21 * 1024 ** 2, 0.2)['workers'] == 2
+    # live requests slow down: halve the transfers and limit each to half its rate
+    controller = mwdeploy.adjust_controller(controller, 20 * 1024 ** 2, 1.5)
+    assert (controller['workers'], controller['bwlimit']) == (1, 5120)
+    assert mwdeploy.adjust_controller(controller, 5 * 1024 ** 2, 1.5)['bwlimit'] == 2560
+    assert mwdeploy.adjust_controller({**controller, 'bwlimit': 1500}, 1024 ** 2, 1.5)['bwlimit'] == 1024
+    assert mwdeploy.adjust_controller(controller, 5 * 1024 ** 2, 0.5)['bwlimit'] == 6400
+    assert mwdeploy.adjust_controller({**controller, 'max_bwlimit': 6000}, 5 * 1024 ** 2, 0.5)['bwlimit'] == 6000
+    # once the limit is well above what the transfers achieve, drop it
+    assert mwdeploy.adjust_controller(controller, 2 * 1024 ** 2, 0.5)['bwlimit'] == 0
+
+
+def test_remote_sync_file_adaptive(transfers: dict) -> None:
+    path = '/srv/mediawiki/config/'
+    commands = []
+
+    def run_transfer(cmd: str, server: str, synced: str, progress: mwdeploy.ProgressConfig) -> int:  # noqa: U100
+        commands.append(cmd)
+        transfers[(server, synced)] = {'server': server, 'transferred': 1024 ** 3, 'percent': 100, 'rate': 0.0, 'eta': '', 'files': 1, 'started': 0.0, 'done': True, 'deferred': False}
+        return 0
+
+    controller: mwdeploy.SyncController = {'workers': 1, 'max_workers': 4, 'bwlimit': 0, 'min_bwlimit': 1024, 'max_bwlimit': 0, 'latency_target': 1.0, 'throughput': 0.0}
+    latencies = iter([2.0, 0.1])
+    servers = ['mw151', 'mw152', 'mw161', 'mw162', 'mw171']
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), patch.object(mwdeploy, 'check_up', return_value=True), patch.object(mwdeploy, 'run_transfer', side_effect=run_transfer), \
+            patch.object(mwdeploy, 'wait', side_effect=itertools.cycle([MagicMock(not_done={1}), MagicMock(not_done=set())])), \
+            patch.object(mwdeploy, 'probe_servers', side_effect=lambda batch, domain: [{'server': server, 'up': True, 'status': 200, 'latency': next(latencies, 0.1)} for server in batch]):  # noqa: U100
+        results = mwdeploy.remote_sync_file(time=False, serverlist=servers, path=path, envinfo=mwdeploy.get_environment_info(), nolog=True, controller=controller)
+    assert [result['server'] for result in results] == servers
+    assert all('--info=progress2' in command for command in commands)
+    # the first batch is unlimited, the slow canary then caps each transfer
+    assert '--bwlimit' not in commands[0]
+    assert all('--bwlimit=' in command for command in commands[1:])
+    # the caller's controller carries the state on to the next path
+    assert controller['bwlimit']
+    assert controller['throughput']
+
+
+def test_rollback_release_dry_run(capsys) -> None:
+    args = argparse.Namespace(servers=['mw151', 'deployhost'], dry_run=True, port=None, force=False, nolog=True, parallel=1)
+    with patch.object(mwdeploy, 'HOSTNAME', 'deployhost'), patch.dict(mwdeploy.versions, {'1.43': '1.43'}, clear=True), \
+            patch.object(mwdeploy, 'run_command') as mock_run, patch.object(mwdeploy, 'check_up') as mock_check_up:
+        assert mwdeploy.rollback_release(args, '1.43') == []
+    mock_run.assert_not_called()
+    mock_check_up.assert_not_called()
+    output = capsys.readouterr().out
+    assert output.startswith('ROLLBACK PLAN for /srv/mediawiki/1.43:')
+    assert 'sudo -u www-data sh -c ' in output
+    assert 'www-data@mw151.wikitide.net' in output